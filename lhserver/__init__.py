@@ -1,3 +1,5 @@
+# compression is installed first so that its plugin wraps the others
+from . import compression  # noqa
 from . import initdb  # noqa
 from . import general  # noqa
 from . import accounts  # noqa
@@ -5,6 +7,13 @@ from . import accounttypes  # noqa
 from . import journals  # noqa
 from . import transactions  # noqa
 from . import gledger  # noqa
+from . import dailybalances  # noqa
+from . import closing  # noqa
+from . import reportcache  # noqa
+from . import columnar  # noqa
+from . import tranaccounts  # noqa
 from . import balancesheet  # noqa
 from . import profitloss  # noqa
 from . import reconcile  # noqa
+from . import changelog  # noqa
+from . import perfstats  # noqa
@@ -1,6 +1,13 @@
 import uuid
+import bisect
+import threading
+import rtlib
 import yenot.backend.api as api
 from . import shared
+from . import reportcache
+from . import tranaccounts
+from . import gledger
+from . import versions
 
 app = api.get_global_app()
 
@@ -29,12 +36,17 @@ where acc_name=%(ref)s"""
             account=api.cgen.pyhacc_account.name(url_key="id", represents=True),
         )
         results.tables["account", True] = api.sql_tab2(conn, select, params, cm)
-    return results.json_out()
+    return results
 
 
-@app.get("/api/accounts/completions", name="get_api_accounts_completions")
-def get_api_accounts_completions(request):
-    prefix = request.query.get("prefix")
+class AccountCompletions:
+    """
+    Sorted in-memory index of account names for the account picker.  It is
+    loaded on first use and reloaded when the content versions of the
+    accounts or account types move, whichever server process wrote them.
+    """
+
+    names = ["accounts", "accounttypes"]
 
     select = """
 select accounts.id, 
@@ -43,19 +55,63 @@ select accounts.id,
     accounts.description
 from hacc.accounts
 join hacc.accounttypes on accounttypes.id=accounts.type_id
-where acc_name ilike %(p)s
-order by acc_name"""
+where accounts.acc_name is not null"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.keys = None
+        self.rows = None
+
+    def _load(self):
+        with app.dbconn() as conn:
+            rows = api.sql_rows(conn, self.select)
+        rows = sorted(rows, key=lambda row: (row.acc_name.lower(), row.acc_name))
+        return [row.acc_name.lower() for row in rows], rows
+
+    def matching(self, prefix):
+        with app.dbconn() as conn:
+            version = versions.current(conn, self.names)
+        with self.lock:
+            if self.version != version:
+                self.keys, self.rows = self._load()
+                self.version = version
+            keys, rows = self.keys, self.rows
+
+        prefix = prefix.lower()
+        index = bisect.bisect_left(keys, prefix)
+        matches = []
+        while index < len(keys) and keys[index].startswith(prefix):
+            matches.append(rows[index])
+            index += 1
+        return matches
 
-    params = {"p": api.sanitize_prefix(prefix)}
+
+completions = AccountCompletions()
+
+
+@app.get("/api/accounts/completions", name="get_api_accounts_completions")
+def get_api_accounts_completions(request):
+    prefix = request.query.get("prefix", "")
+
+    columns = [
+        ("id", api.cgen.pyhacc_account.surrogate()),
+        ("type", api.cgen.auto()),
+        ("acc_name", api.cgen.pyhacc_account.name(url_key="id", represents=True)),
+        ("description", api.cgen.auto()),
+    ]
+    rtable = rtlib.ClientTable(columns, [])
+    for acc in completions.matching(prefix):
+        with rtable.adding_row() as row:
+            row.id = acc.id
+            row.type = acc.type
+            row.acc_name = acc.acc_name
+            row.description = acc.description
 
     results = api.Results()
-    with app.dbconn() as conn:
-        cm = api.ColumnMap(
-            id=api.cgen.pyhacc_account.surrogate(),
-            account=api.cgen.pyhacc_account.name(url_key="id", represents=True),
-        )
-        results.tables["accounts", True] = api.sql_tab2(conn, select, params, cm)
-    return results.json_out()
+    cm = {attr: values for attr, values in columns}
+    results.tables["accounts", True] = rtable.as_tab2(column_map=cm)
+    return results
 
 
 def get_api_accounts_list_prompts():
@@ -113,6 +169,11 @@ where /*WHERE*/"""
 
     results = api.Results(default_title=True)
     with app.dbconn() as conn:
+        notmodified = versions.not_modified(
+            conn, request, ["accounts", "accounttypes", "journals"]
+        )
+        if notmodified != None:
+            return notmodified
         cm = api.ColumnMap(
             id=api.cgen.pyhacc_account.surrogate(),
             account=api.cgen.pyhacc_account.name(url_key="id", represents=True),
@@ -129,7 +190,7 @@ where /*WHERE*/"""
             ),
         )
         results.tables["accounts", True] = api.sql_tab2(conn, select, params, cm)
-    return results.json_out()
+    return results
 
 
 def _get_api_account(a_id=None, newrow=False):
@@ -178,14 +239,187 @@ where /*WHERE*/"""
 @app.get("/api/account/<a_id>", name="get_api_account")
 def get_api_account(a_id):
     results = _get_api_account(a_id)
-    return results.json_out()
+    return results
 
 
 @app.get("/api/account/new", name="get_api_account_new")
 def get_api_account_new():
     results = _get_api_account(newrow=True)
     results.keys["new_row"] = True
-    return results.json_out()
+    return results
+
+
+REGISTER_PAGE = 200
+
+# The page of splits is found by keyset on (date, tid, sid) in either
+# direction through the index splits_register_idx on (account_id, trandate,
+# stid, sid) so a page reads only its rows.  The running balance starts from
+# the balance before the first row of the page: the daily cumulative through
+# the prior date plus the earlier splits on the same date.
+ACCOUNT_REGISTER = """
+with page as (
+    select splits.sid, splits.sum, splits.stid as tid, splits.trandate
+    from hacc.splits
+    where splits.account_id=%(account)s and /*KEYSET*/
+    order by splits.trandate /*DIR*/, splits.stid /*DIR*/, splits.sid /*DIR*/
+    limit %(limit)s
+), first as (
+    select page.trandate, page.tid, page.sid
+    from page
+    order by page.trandate, page.tid, page.sid
+    limit 1
+), opening as (
+    select
+        coalesce((
+            select adb.cumulative
+            from hacc.account_daily_balances adb
+            where adb.account_id=%(account)s and adb.bal_date<first.trandate
+            order by adb.bal_date desc
+            limit 1), 0)
+        + coalesce((
+            select sum(splits.sum)
+            from hacc.splits
+            where splits.account_id=%(account)s
+                and splits.trandate=first.trandate
+                and (splits.stid, splits.sid)<(first.tid, first.sid)), 0) as debit
+    from first
+)
+select
+    page.tid, page.sid,
+    page.trandate as date,
+    transactions.tranref as reference,
+    transactions.payee, transactions.memo,
+    case when page.sum>=0 then page.sum end as debit,
+    case when page.sum<0 then -page.sum end as credit,
+    (opening.debit + sum(page.sum) over (
+        order by page.trandate, page.tid, page.sid))
+        * (case when accounttypes.debit then 1 else -1 end) as balance
+from page
+join hacc.transactions on transactions.tid=page.tid
+cross join opening
+join hacc.accounts on accounts.id=%(account)s
+join hacc.accounttypes on accounttypes.id=accounts.type_id
+order by page.trandate, page.tid, page.sid
+"""
+
+REGISTER_KEY = "(splits.trandate, splits.stid, splits.sid)"
+REGISTER_CURSOR_KEY = "(%(cdate)s, %(ctid)s::uuid, %(csid)s::uuid)"
+
+
+def _register_cursor(cursor, params):
+    cdate, _, keys = cursor.partition("/")
+    ctid, _, csid = keys.partition("/")
+    try:
+        params["cdate"] = api.parse_date(cdate)
+        params["ctid"] = str(uuid.UUID(ctid))
+        params["csid"] = str(uuid.UUID(csid))
+    except ValueError:
+        params["cdate"] = None
+    if params["cdate"] == None:
+        raise api.UserError("parameter-validation", "Invalid page cursor.")
+
+
+@app.get(
+    "/api/account/<acnt_id>/register",
+    name="get_api_account_register",
+    report_title="Account Register",
+)
+def get_api_account_register(acnt_id, request):
+    """
+    Return a page of the splits of the account in date order with the running
+    balance.  Page forward with `after` (or from `date`) and backward with
+    `before` using the cursors next-cursor and prev-cursor; with neither
+    the last page is returned.  A cursor is given only if there are rows
+    beyond it.
+    """
+    after = request.query.get("after", None)
+    before = request.query.get("before", None)
+    date = api.parse_date(request.query.get("date", None))
+    limit = api.parse_int(request.query.get("limit", None))
+
+    if limit == None:
+        limit = REGISTER_PAGE
+    if limit <= 0:
+        raise api.UserError("parameter-validation", "The page size must be positive.")
+    if len([x for x in [after, before, date] if x not in ["", None]]) > 1:
+        raise api.UserError(
+            "parameter-validation", "Give at most one of after, before and date."
+        )
+    try:
+        acnt_id = str(uuid.UUID(acnt_id))
+    except ValueError:
+        raise api.UserError("invalid-param", "The account does not exist.")
+
+    # one extra row tells if there is another page
+    params = {"account": acnt_id, "limit": limit + 1}
+    backward = after in ["", None] and date == None
+    if after not in ["", None]:
+        _register_cursor(after, params)
+        keyset = f"{REGISTER_KEY}>{REGISTER_CURSOR_KEY}"
+    elif date != None:
+        params["cdate"] = date
+        keyset = "splits.trandate>=%(cdate)s"
+    elif before not in ["", None]:
+        _register_cursor(before, params)
+        keyset = f"{REGISTER_KEY}<{REGISTER_CURSOR_KEY}"
+    else:
+        keyset = "true"
+
+    select = ACCOUNT_REGISTER.replace("/*KEYSET*/", keyset).replace(
+        "/*DIR*/", "desc" if backward else "asc"
+    )
+
+    select_earlier = f"""
+select exists(
+    select 1
+    from hacc.splits
+    where splits.account_id=%(account)s
+        and {REGISTER_KEY}<{REGISTER_CURSOR_KEY})"""
+
+    results = api.Results(default_title=True)
+    with app.dbconn() as conn:
+        accname = api.sql_1row(
+            conn, "select acc_name from hacc.accounts where id=%(a)s", {"a": acnt_id}
+        )
+        if accname == None:
+            raise api.UserError("invalid-param", "The account does not exist.")
+        results.key_labels += f"Account:  {accname}"
+
+        cm = api.ColumnMap(
+            tid=api.cgen.pyhacc_transaction.surrogate(
+                row_url_label="Transaction", represents=True
+            ),
+            sid=api.cgen.__meta__(),
+            debit=api.cgen.currency_usd(widget_kwargs={"blankzero": True}),
+            credit=api.cgen.currency_usd(widget_kwargs={"blankzero": True}),
+            balance=api.cgen.currency_usd(),
+        )
+        columns, rows = api.sql_tab2(conn, select, params, cm)
+
+        more = len(rows) > limit
+        if more:
+            # the extra row is beyond the page in the direction of travel
+            rows = rows[1:] if backward else rows[:-1]
+        if len(rows) > 0:
+            first, last = rows[0], rows[-1]
+            if backward:
+                earlier = more
+            elif after not in ["", None]:
+                # the cursor row itself is earlier
+                earlier = True
+            else:
+                params["cdate"] = first.date
+                params["ctid"] = str(first.tid)
+                params["csid"] = str(first.sid)
+                earlier = api.sql_1row(conn, select_earlier, params)
+            later = more if not backward else before not in ["", None]
+            if earlier:
+                results.keys["prev-cursor"] = f"{first.date}/{first.tid}/{first.sid}"
+            if later:
+                results.keys["next-cursor"] = f"{last.date}/{last.tid}/{last.sid}"
+    results.tables["splits", True] = columns, rows
+
+    return results
 
 
 @app.put("/api/account/<acnt_id>", name="put_api_account")
@@ -198,12 +432,26 @@ def put_account(acnt_id):
     for row in acc.rows:
         row.id = acnt_id
 
+    select_name = "select acc_name from hacc.accounts where id=%(a)s"
+    select_journal = "select journal_id from hacc.accounts where id=%(a)s"
+
     with app.dbconn() as conn:
+        oldname = api.sql_1row(conn, select_name, {"a": acnt_id})
+        oldjournal = api.sql_1row(conn, select_journal, {"a": acnt_id})
         with api.writeblock(conn) as w:
             w.upsert_rows("hacc.accounts", acc)
+        newname = api.sql_1row(conn, select_name, {"a": acnt_id})
+        newjournal = api.sql_1row(conn, select_journal, {"a": acnt_id})
+        if oldname != None and oldname != newname:
+            tranaccounts.refresh_accounts(conn, [acnt_id])
+        if oldjournal != None and oldjournal != newjournal:
+            # transactions balance within each journal
+            gledger.refresh_unbalanced_accounts(conn, [acnt_id])
+        versions.bump(conn, ["accounts", "ledger"])
         conn.commit()
+    reportcache.clear()
 
-    return api.Results().json_out()
+    return api.Results()
 
 
 @app.delete("/api/account/<acnt_id>", name="delete_api_account")
@@ -220,7 +468,28 @@ def delete_account(acnt_id):
                 "data-check", "This account is referenced by transactions."
             )
 
+        api.sql_void(
+            conn,
+            """
+delete from hacc.reconcile_statement_splits
+where statement_id in (
+    select id from hacc.reconcile_statements where account_id=%(acnt_id)s)""",
+            params,
+        )
+        api.sql_void(
+            conn,
+            "delete from hacc.reconcile_statements where account_id=%(acnt_id)s",
+            params,
+        )
+        # any remaining daily balance rows are zero since there are no splits
+        api.sql_void(
+            conn,
+            "delete from hacc.account_daily_balances where account_id=%(acnt_id)s",
+            params,
+        )
         api.sql_void(conn, "delete from hacc.accounts where id=%(acnt_id)s", params)
+        versions.bump(conn, ["accounts", "ledger"])
         conn.commit()
+    reportcache.clear()
 
-    return api.Results().json_out()
+    return api.Results()
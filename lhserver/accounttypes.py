@@ -1,5 +1,8 @@
 import uuid
 import yenot.backend.api as api
+from . import reportcache
+from . import tranaccounts
+from . import versions
 
 app = api.get_global_app()
 
@@ -9,13 +12,16 @@ app = api.get_global_app()
     name="get_api_accounttypes_list",
     report_title="Account Types List",
 )
-def get_api_accounttypes_list():
+def get_api_accounttypes_list(request):
     select = """
 select *
 from hacc.accounttypes"""
 
     results = api.Results(default_title=True)
     with app.dbconn() as conn:
+        notmodified = versions.not_modified(conn, request, ["accounttypes"])
+        if notmodified != None:
+            return notmodified
         cm = api.ColumnMap(
             id=api.cgen.pyhacc_accounttype.surrogate(),
             atype_name=api.cgen.pyhacc_accounttype.name(
@@ -23,7 +29,7 @@ from hacc.accounttypes"""
             ),
         )
         results.tables["accounttypes", True] = api.sql_tab2(conn, select, column_map=cm)
-    return results.json_out()
+    return results
 
 
 @app.get("/api/accounttype/new", name="get_api_accounttype_new")
@@ -42,7 +48,7 @@ where false"""
 
         rows = api.tab2_rows_default(columns, [None], default_row)
         results.tables["accounttype", True] = columns, rows
-    return results.json_out()
+    return results
 
 
 @app.get("/api/accounttype/<atype_id>", name="get_api_accounttype")
@@ -57,7 +63,7 @@ where id=%(at)s"""
         results.tables["accounttype", True] = api.sql_tab2(
             conn, select, {"at": atype_id}
         )
-    return results.json_out()
+    return results
 
 
 @app.put("/api/accounttype/<atype_id>", name="put_api_accounttype")
@@ -72,9 +78,18 @@ def put_accounttype(atype_id):
     for row in atype.rows:
         row.id = atype_id
 
+    select_sort = "select sort from hacc.accounttypes where id=%(at)s"
+
     with app.dbconn() as conn:
+        oldsort = api.sql_1row(conn, select_sort, {"at": atype_id})
         with api.writeblock(conn) as w:
             w.upsert_rows("hacc.accounttypes", atype)
+        newsort = api.sql_1row(conn, select_sort, {"at": atype_id})
+        if oldsort != newsort:
+            # the account summaries order equal amounts by type sort
+            tranaccounts.refresh_accounttype(conn, atype_id)
+        versions.bump(conn, ["accounttypes", "ledger"])
         conn.commit()
+    reportcache.clear()
 
-    return api.Results().json_out()
+    return api.Results()
@@ -1,31 +1,26 @@
 import datetime
-import re
 import yenot.backend.api as api
 from . import shared
 from . import bankday
+from . import reportcache
 
 app = api.get_global_app()
 
 
-def dcb_values(debit, debit_amt):
-    if debit_amt == None:
-        return None, None, None
-    d = debit_amt if debit else None
-    c = -debit_amt if not debit else None
-    b = debit_amt * (1 if debit else -1) if debit_amt != None else None
-    return d, c, b
-
-
-BALANCE_SHEET_AT_D = """
+BALANCE_SHEET_AT_D = f"""
 with balances as (
     select 
         accounts.id, accounts.type_id, accounts.retearn_id, 
-        sum(splits.sum) as debit
+        adb.cumulative as debit
     from hacc.accounts
-    join hacc.splits on splits.account_id=accounts.id
-    join hacc.transactions on transactions.tid=splits.stid
-    where transactions.trandate<=%(d)s
-    group by accounts.id, accounts.type_id, accounts.retearn_id
+    join lateral (
+        select account_daily_balances.cumulative
+        from hacc.account_daily_balances
+        where account_daily_balances.account_id=accounts.id
+            and account_daily_balances.bal_date<=%(d)s
+        order by account_daily_balances.bal_date desc
+        limit 1
+        ) adb on true
 ), balsheet as (
     select
         case when accounttypes.balance_sheet then balances.id else ret.id end as account_id, 
@@ -43,7 +38,7 @@ select
     journals.jrn_name, 
     accounts.id, accounts.acc_name, 
     accounts.description,
-    balsheet.debit
+    {shared.debit_credit_balance("balsheet.debit", "accounttypes.debit")}
 from (
     select balsheet.account_id, sum(balsheet.debit) as debit
     from balsheet
@@ -69,6 +64,7 @@ def get_api_gledger_balance_sheet_prompts():
     report_prompts=get_api_gledger_balance_sheet_prompts,
     report_sidebars=shared.account_sidebar("id"),
 )
+@reportcache.cached(span=reportcache.span_through_date)
 def get_api_gledger_balance_sheet(request):
     date = api.parse_date(request.query.get("date"))
 
@@ -95,25 +91,11 @@ def get_api_gledger_balance_sheet(request):
             balance=api.cgen.currency_usd(),
         )
         params = {"d": date}
-        data = api.sql_tab2(conn, select, params, cm)
-
-        columns = api.tab2_columns_transform(
-            data[0], insert=[("debit", "credit", "balance")], column_map=cm
-        )
-
-        def transform_dc(oldrow, row):
-            d, c, b = dcb_values(row.debit_account, row.debit)
-            row.balance = b
-            row.debit = d
-            row.credit = c
-
-        rows = api.tab2_rows_transform(data, columns, transform_dc)
-
-        results.tables["balances", True] = columns, rows
+        results.tables["balances", True] = api.sql_tab2(conn, select, params, cm)
 
     results.keys["report-formats"] = ["gl_summarize_by_type"]
     results.keys["report-refresh"] = [{"channel": "transactions"}]
-    return results.json_out()
+    return results
 
 
 def get_api_gledger_balance_sheet_summary_prompts():
@@ -128,6 +110,7 @@ def get_api_gledger_balance_sheet_summary_prompts():
     report_title="Balance Sheet Summary",
     report_prompts=get_api_gledger_balance_sheet_summary_prompts,
 )
+@reportcache.cached(span=reportcache.span_through_date)
 def get_api_gledger_balance_sheet_summary(request):
     date = api.parse_date(request.query.get("date"))
 
@@ -142,7 +125,9 @@ select
     bsacc.atype_name,
     bsacc.atype_sort,
     bsacc.debit_account,
-    sum(bsacc.debit) as debit
+    sum(bsacc.debit) as debit,
+    sum(bsacc.credit) as credit,
+    sum(bsacc.balance) as balance
 from bsacc
 group by 
     bsacc.jrn_id,
@@ -171,25 +156,11 @@ order by bsacc.jrn_name, bsacc.atype_sort
             balance=api.cgen.currency_usd(hidden=True),
         )
         params = {"d": date}
-        data = api.sql_tab2(conn, select, params, cm)
-
-        columns = api.tab2_columns_transform(
-            data[0], insert=[("debit", "credit", "balance")], column_map=cm
-        )
-
-        def transform_dc(oldrow, row):
-            d, c, b = dcb_values(row.debit_account, row.debit)
-            row.balance = b
-            row.debit = d
-            row.credit = c
-
-        rows = api.tab2_rows_transform(data, columns, transform_dc)
-
-        results.tables["balances", True] = columns, rows
+        results.tables["balances", True] = api.sql_tab2(conn, select, params, cm)
 
     results.keys["report-formats"] = ["gl_summarize_by_type"]
     results.keys["report-refresh"] = [{"channel": "transactions"}]
-    return results.json_out()
+    return results
 
 
 def get_api_gledger_current_balance_accounts_prompts():
@@ -205,6 +176,7 @@ def get_api_gledger_current_balance_accounts_prompts():
     report_prompts=get_api_gledger_current_balance_accounts_prompts,
     report_sidebars=shared.account_sidebar("id"),
 )
+@reportcache.cached(span=reportcache.span_current_balance)
 def get_api_gledger_current_balance_accounts(request):
     date = api.parse_date(request.query.get("date"))
 
@@ -226,7 +198,9 @@ select
     journals.id as jrn_id, journals.jrn_name,
     accounts.id, accounts.acc_name,
     accounts.description,
-    balance.debit
+    balance.debit,
+    balance.credit,
+    balance.balance
 from hacc.accounts
 left outer join hacc.journals on journals.id=accounts.journal_id
 left outer join hacc.accounttypes on accounttypes.id=accounts.type_id
@@ -259,21 +233,7 @@ order by accounttypes.sort, journals.jrn_name, accounts.acc_name
             balance=api.cgen.currency_usd(),
         )
         params = {"d": date}
-        data = api.sql_tab2(conn, select, params, cm)
-
-        columns = api.tab2_columns_transform(
-            data[0], insert=[("debit", "credit", "balance")], column_map=cm
-        )
-
-        def transform_dc(oldrow, row):
-            d, c, b = dcb_values(row.debit_account, row.debit)
-            row.balance = b
-            row.debit = d
-            row.credit = c
-
-        rows = api.tab2_rows_transform(data, columns, transform_dc)
-
-        results.tables["balances", True] = columns, rows
+        results.tables["balances", True] = api.sql_tab2(conn, select, params, cm)
 
     results.keys["report-formats"] = ["gl_summarize_by_type"]
     # ultimately, this calls back to api/transactions/reconcile
@@ -281,7 +241,7 @@ order by accounttypes.sort, journals.jrn_name, accounts.acc_name
         ("Reconcile", "pyhacc:reconcile", {}, {"account": "id"})
     ]
     results.keys["report-refresh"] = [{"channel": "transactions"}]
-    return results.json_out()
+    return results
 
 
 def get_api_gledger_multi_balance_sheet_prompts():
@@ -303,6 +263,7 @@ def get_api_gledger_multi_balance_sheet_prompts():
     report_prompts=get_api_gledger_multi_balance_sheet_prompts,
     report_sidebars=shared.account_sidebar("id"),
 )
+@reportcache.cached(span=reportcache.span_multi_balance_sheet)
 def get_api_gledger_multi_balance_sheet(request):
     year = api.parse_int(request.query.get("year"))
     month = api.parse_int(request.query.get("month_end"))
@@ -313,61 +274,85 @@ def get_api_gledger_multi_balance_sheet(request):
             "invalid-param", "This report requires at least 1 interval."
         )
 
+    # All the period ends are probed from the daily balances in one query and
+    # pivoted with filtered sums rather than joining a balance sheet per
+    # period.
     select = """
-with /*BAL_N_CTE*/
+with dates as (
+    select dates.bal_date, dates.n-1 as period
+    from unnest(%(dates)s::date[]) with ordinality as dates(bal_date, n)
+), balances as (
+    select 
+        accounts.id, accounts.type_id, accounts.retearn_id, 
+        dates.period, adb.cumulative as debit
+    from hacc.accounts
+    cross join dates
+    join lateral (
+        select account_daily_balances.cumulative
+        from hacc.account_daily_balances
+        where account_daily_balances.account_id=accounts.id
+            and account_daily_balances.bal_date<=dates.bal_date
+        order by account_daily_balances.bal_date desc
+        limit 1
+        ) adb on true
+), balsheet as (
+    select
+        case when accounttypes.balance_sheet then balances.id else ret.id end as account_id, 
+        balances.period,
+        balances.debit
+    from balances
+    join hacc.accounttypes on accounttypes.id=balances.type_id
+    left outer join hacc.accounts ret on ret.id=balances.retearn_id
+), pivot as (
+    select balsheet.account_id,
+        /*BAL_N_SUMS*/
+    from balsheet
+    group by balsheet.account_id
+)
 select 
-    /*COALESCE_COL(atype_id)*/ as atype_id,
-    /*COALESCE_COL(atype_name)*/ as atype_name,
-    /*COALESCE_COL(atype_sort)*/ as atype_sort,
-    /*COALESCE_COL(debit_account)*/ as debit_account,
-    /*COALESCE_COL(jrn_id)*/ as jrn_id,
-    /*COALESCE_COL(jrn_name)*/ as jrn_name,
-    /*COALESCE_COL(id)*/ as id,
-    /*COALESCE_COL(acc_name)*/ as acc_name,
-    /*COALESCE_COL(description)*/ as description,
-    /*BAL_N_DEBIT*/
-from /*BAL_N_JOINS*/
-order by 
-    /*COALESCE_COL(atype_sort)*/,
-    /*COALESCE_COL(jrn_name)*/,
-    /*COALESCE_COL(acc_name)*/
+    accounttypes.id as atype_id, 
+    accounttypes.atype_name, 
+    accounttypes.sort as atype_sort,
+    accounttypes.debit as debit_account, 
+    journals.id as jrn_id,
+    journals.jrn_name, 
+    accounts.id, accounts.acc_name, 
+    accounts.description,
+    /*BAL_N_DCB*/
+from pivot
+join hacc.accounts on accounts.id=pivot.account_id
+join hacc.accounttypes on accounttypes.id=accounts.type_id
+join hacc.journals on journals.id=accounts.journal_id
+where coalesce(/*BAL_N_DEBIT*/) is not null
+order by accounttypes.sort, journals.jrn_name, accounts.acc_name
 """
 
     params = {}
-    cte_list = []
+    sums_list = []
+    dcb_list = []
     debit_list = []
-    joins_list = []
     for index in range(count):
         params[f"d{index}"] = bankday.month_end(datetime.date(year - index, month, 1))
-        s = "bal{0} as (\n\t" + BALANCE_SHEET_AT_D.replace("%(d)s", "%(d{0})s") + "\n)"
-        cte_list.append(s.format(index))
-        debit_list.append("bal{0}.debit as debit{0}".format(index))
-        if index == 0:
-            joins_list.append(f"bal{index}")
-        elif index == 1:
-            joins_list.append("bal{0} on bal{0}.id=bal0.id".format(index))
-        elif index >= 2:
-            prior = [f"bal{i2}.id" for i2 in range(index)]
-            joins_list.append(
-                "bal{0} on bal{0}.id=coalesce({1})".format(index, ", ".join(prior))
+        sums_list.append(
+            f"nullif(sum(balsheet.debit) filter (where balsheet.period={index}), 0) as debit{index}"
+        )
+        dcb_list.append(
+            shared.debit_credit_balance(
+                f"pivot.debit{index}", "accounttypes.debit", suffix=index
             )
+        )
+        debit_list.append(f"pivot.debit{index}")
+    params["dates"] = [params[f"d{index}"] for index in range(count)]
 
     select = (
-        select.replace("/*BAL_N_CTE*/", ", ".join(cte_list))
-        .replace("/*BAL_N_DEBIT*/", ",\n\t".join(debit_list))
-        .replace("/*BAL_N_JOINS*/", "\nfull outer join ".join(joins_list))
+        select.replace("/*BAL_N_SUMS*/", ",\n\t".join(sums_list))
+        .replace("/*BAL_N_DCB*/", ",\n\t".join(dcb_list))
+        .replace("/*BAL_N_DEBIT*/", ", ".join(debit_list))
     )
 
-    def coalfunc(m):
-        cols = [f"bal{index}.{m.group(1)}" for index in range(count)]
-        return f"coalesce({', '.join(cols)})"
-
-    select = re.sub(r"/\*COALESCE_COL\(([a-z0-9_]+)\)\*/", coalfunc, select)
-
     results = api.Results(default_title=True)
     results.key_labels += f"Date:  {params['d0']} and {count - 1} annual comparisons"
     with app.dbconn() as conn:
-        inserts = []
         colkwargs = {}
         for index in range(count):
             d, c, b = (
@@ -382,7 +367,6 @@ order by
                     b: api.cgen.currency_usd(label=f"Balance\n{params[f'd{index}']}"),
                 }
             )
-            inserts.append((d, c, b))
 
         cm = shared.HaccColumnMap(
             id=api.cgen.pyhacc_account.surrogate(),
@@ -400,27 +384,8 @@ order by
             jrn_name=api.cgen.pyhacc_journal.name(label="Journal", url_key="jrn_id"),
             **colkwargs,
         )
-        data = api.sql_tab2(conn, select, params, cm)
-
-        columns = api.tab2_columns_transform(data[0], insert=inserts, column_map=cm)
-
-        def transform_dc(oldrow, row):
-            for index in range(count):
-                d_at, c_at, b_at = (
-                    f"debit{index}",
-                    f"credit{index}",
-                    f"balance{index}",
-                )
-
-                d, c, b = dcb_values(row.debit_account, getattr(row, d_at))
-                setattr(row, b_at, b)
-                setattr(row, d_at, d)
-                setattr(row, c_at, c)
-
-        rows = api.tab2_rows_transform(data, columns, transform_dc)
-
-        results.tables["balances", True] = columns, rows
+        results.tables["balances", True] = api.sql_tab2(conn, select, params, cm)
 
     results.keys["report-formats"] = ["gl_summarize_by_type"]
     results.keys["report-refresh"] = [{"channel": "transactions"}]
-    return results.json_out()
+    return results
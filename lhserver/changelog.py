@@ -0,0 +1,186 @@
+import yenot.backend.api as api
+from . import versions
+
+app = api.get_global_app()
+
+# The transaction writers log the inserted, updated and deleted transactions
+# and splits in hacc.transaction_changes under the ledger version they bumped.
+# The ledger version row stays locked until the writer commits so versions
+# become visible in order and a client can resume from the last version it
+# saw.  The log is pruned through a version with the DELETE route; the pruned
+# version is kept as changes-pruned in hacc.content_versions.
+
+SNAPSHOT = """
+select transactions.tid::text as tid, transactions.trandate,
+    to_jsonb(transactions)::text as tran_image,
+    splits.sid::text as sid,
+    (to_jsonb(splits) || jsonb_build_object('tags', array(
+        select tagsplits.tag_id::text
+        from hacc.tagsplits
+        where tagsplits.split_id=splits.sid
+        order by tagsplits.tag_id)))::text as split_image
+from hacc.transactions
+left outer join hacc.splits on splits.stid=transactions.tid
+where transactions.tid=any(%(tids)s::uuid[])
+"""
+
+INSERT_CHANGES = """
+insert into hacc.transaction_changes (version, tid, sid, trandate, change)
+select %(version)s, changes.*
+from unnest(%(tids)s::uuid[], %(sids)s::uuid[], %(dates)s::date[], %(changes)s::text[])
+    as changes(tid, sid, trandate, change)
+"""
+
+
+def snapshot(conn, tids):
+    """
+    Return {tid: (trandate, transaction image, {sid: split image})} of the
+    transactions `tids` to diff before and after a write.  The images are the
+    rows (with the split tags) as json text.
+    """
+    result = {}
+    for row in api.sql_rows(conn, SNAPSHOT, {"tids": list(tids)}):
+        _, _, splits = result.setdefault(
+            row.tid, (row.trandate, row.tran_image, {})
+        )
+        if row.sid != None:
+            splits[row.sid] = row.split_image
+    return result
+
+
+def record(conn, version, before, after):
+    """
+    Log the differences of the snapshots `before` and `after`; unchanged
+    transactions and splits are not logged.
+    """
+    changes = []
+    for tid in set(before) | set(after):
+        if tid not in after:
+            trandate, _, oldsplits = before[tid]
+            changes.append((tid, None, trandate, "delete"))
+            changes += [(tid, sid, trandate, "delete") for sid in oldsplits]
+            continue
+        trandate, image, newsplits = after[tid]
+        olddate, oldimage, oldsplits = before.get(tid, (None, None, {}))
+        splitchanges = [
+            (tid, sid, trandate, "insert" if sid not in oldsplits else "update")
+            for sid in newsplits
+            if newsplits[sid] != oldsplits.get(sid)
+        ]
+        splitchanges += [
+            (tid, sid, olddate, "delete") for sid in oldsplits if sid not in newsplits
+        ]
+        if tid not in before:
+            changes.append((tid, None, trandate, "insert"))
+        elif image != oldimage or len(splitchanges) > 0:
+            changes.append((tid, None, trandate, "update"))
+        changes += splitchanges
+
+    if len(changes) == 0:
+        return
+
+    params = {
+        "version": version,
+        "tids": [c[0] for c in changes],
+        "sids": [c[1] for c in changes],
+        "dates": [c[2] for c in changes],
+        "changes": [c[3] for c in changes],
+    }
+    api.sql_void(conn, INSERT_CHANGES, params)
+
+
+def record_inserts(conn, version, tids):
+    api.sql_void(
+        conn,
+        """
+insert into hacc.transaction_changes (version, tid, sid, trandate, change)
+select %(version)s, transactions.tid, null, transactions.trandate, 'insert'
+from hacc.transactions
+where transactions.tid=any(%(tids)s::uuid[])
+union all
+select %(version)s, splits.stid, splits.sid, transactions.trandate, 'insert'
+from hacc.splits
+join hacc.transactions on transactions.tid=splits.stid
+where splits.stid=any(%(tids)s::uuid[])""",
+        {"version": version, "tids": list(tids)},
+    )
+
+
+@app.get("/api/transactions/changes", name="get_api_transactions_changes")
+def get_api_transactions_changes(request):
+    """
+    Return the transactions (sid null) and splits changed after the ledger
+    version `since` netted to one change each.  The key cursor is the version
+    to pass as `since` on the next call.  If the log was pruned past `since`
+    the result is empty with the key reset and the client must reload.
+    """
+    since = api.parse_int(request.query.get("since", None))
+
+    if since == None:
+        raise api.UserError(
+            "parameter-validation", "The since version is required."
+        )
+
+    select = """
+with netted as (
+    select tc.tid, tc.sid,
+        (array_agg(tc.change order by tc.version, tc.id))[1] as first_change,
+        (array_agg(tc.change order by tc.version desc, tc.id desc))[1] as last_change,
+        (array_agg(tc.trandate order by tc.version desc, tc.id desc))[1] as trandate
+    from hacc.transaction_changes tc
+    where tc.version>%(since)s and tc.version<=%(through)s
+    group by tc.tid, tc.sid
+)
+select netted.tid, netted.sid, netted.trandate,
+    case when netted.first_change='insert' then 'insert'
+        when netted.last_change='delete' then 'delete'
+        else 'update' end as change
+from netted
+where not (netted.first_change='insert' and netted.last_change='delete')
+order by netted.trandate, netted.tid, netted.sid nulls first
+"""
+
+    results = api.Results()
+    with app.dbconn() as conn:
+        through = versions.ledger_version(conn)
+        params = {"since": since, "through": through}
+        columns, rows = api.sql_tab2(conn, select, params)
+        # read after the changes so a concurrent prune is seen
+        pruned = versions.current(conn, ["changes-pruned"])["changes-pruned"]
+        if since < pruned:
+            rows = []
+            results.keys["reset"] = True
+        results.tables["changes", True] = columns, rows
+        results.keys["cursor"] = through
+    return results
+
+
+@app.delete("/api/transactions/changes", name="delete_api_transactions_changes")
+def delete_api_transactions_changes(request):
+    """
+    Prune the change log through the ledger version `through`.
+    """
+    through = api.parse_int(request.query.get("through", None))
+
+    if through == None:
+        raise api.UserError(
+            "parameter-validation", "The through version is required."
+        )
+
+    with app.dbconn() as conn:
+        api.sql_void(
+            conn,
+            """
+insert into hacc.content_versions (name, version)
+values ('changes-pruned', %(through)s)
+on conflict (name) do update
+    set version=greatest(content_versions.version, excluded.version)""",
+            {"through": through},
+        )
+        api.sql_void(
+            conn,
+            "delete from hacc.transaction_changes where version<=%(through)s",
+            {"through": through},
+        )
+        conn.commit()
+    return api.Results()
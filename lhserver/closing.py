@@ -0,0 +1,89 @@
+import yenot.backend.api as api
+from . import dailybalances
+
+app = api.get_global_app()
+
+
+def latest_close(conn):
+    return api.sql_1row(conn, "select max(close_date) from hacc.period_closes")
+
+
+def check_open_dates(conn, dates):
+    """
+    Raise a UserError if any of `dates` falls in a closed period.  Writers
+    call this holding the locks of their accounts (see
+    dailybalances.lock_accounts) so that no write lands in a period as it is
+    closed.  The balances as of a close are those of
+    hacc.account_daily_balances through the close date, which the closed
+    period no longer changes.
+    """
+    dates = [d for d in dates if d != None]
+    closed = latest_close(conn)
+    if closed != None and len(dates) > 0 and min(dates) <= closed:
+        raise api.UserError(
+            "closed-period",
+            f"The books are closed through {closed}; transactions on or before that date cannot be changed.",
+        )
+
+
+@app.get(
+    "/api/gledger/period-closes",
+    name="get_api_gledger_period_closes",
+    report_title="Closed Periods",
+)
+def get_api_gledger_period_closes():
+    select = """
+select period_closes.close_date, period_closes.closed_at
+from hacc.period_closes
+order by period_closes.close_date desc
+"""
+
+    results = api.Results(default_title=True)
+    with app.dbconn() as conn:
+        results.tables["closes", True] = api.sql_tab2(conn, select)
+    return results
+
+
+@app.put("/api/gledger/close-period", name="put_api_gledger_close_period")
+def put_api_gledger_close_period(request):
+    date = api.parse_date(request.query.get("date"))
+
+    if date == None:
+        raise api.UserError("parameter-validation", "Enter the closing date.")
+
+    with app.dbconn() as conn:
+        # wait out the transaction writers in flight so no writer slips in
+        # behind the close
+        dailybalances.lock_all_accounts(conn)
+        closed = latest_close(conn)
+        if closed != None and date <= closed:
+            raise api.UserError(
+                "closed-period", f"The books are already closed through {closed}."
+            )
+
+        params = {"d": date}
+        api.sql_void(
+            conn, "insert into hacc.period_closes (close_date) values (%(d)s)", params
+        )
+        conn.commit()
+    return api.Results()
+
+
+@app.delete("/api/gledger/close-period", name="delete_api_gledger_close_period")
+def delete_api_gledger_close_period(request):
+    date = api.parse_date(request.query.get("date"))
+
+    with app.dbconn() as conn:
+        dailybalances.lock_all_accounts(conn)
+        closed = latest_close(conn)
+        if closed == None or date != closed:
+            raise api.UserError(
+                "invalid-param", "Only the most recent period close can be reopened."
+            )
+
+        params = {"d": date}
+        api.sql_void(
+            conn, "delete from hacc.period_closes where close_date=%(d)s", params
+        )
+        conn.commit()
+    return api.Results()
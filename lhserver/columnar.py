@@ -0,0 +1,116 @@
+import json
+import functools
+import bottle
+import yenot.backend.api as api
+
+app = api.get_global_app()
+
+# A client asking for CONTENT_TYPE in the Accept header gets the tables of any
+# lhserver route as column arrays rather than tab2 rows.  String columns with
+# repeated values (account, journal & type names) are dictionary encoded as
+# {"dictionary": [distinct values], "indices": [index per row]}.
+
+CONTENT_TYPE = "application/vnd.lhserver.columnar+json"
+
+
+def wants_columnar(request):
+    return CONTENT_TYPE in request.headers.get("Accept", "")
+
+
+def mark_response():
+    bottle.response.content_type = CONTENT_TYPE
+
+
+def encode_column(values):
+    strings = [v for v in values if v != None]
+    if len(strings) == 0 or not all(isinstance(v, str) for v in strings):
+        return values
+    distinct = {}
+    indices = [
+        None if v == None else distinct.setdefault(v, len(distinct)) for v in values
+    ]
+    if len(distinct) * 2 > len(values):
+        # mostly unique (eg. memo) -- the dictionary saves nothing
+        return values
+    return {"dictionary": list(distinct), "indices": indices}
+
+
+def tab2_parts(value):
+    """
+    Return (columns, rows) if `value` is a tab2 table as serialized by yenot
+    -- [columns, rows] or an object with columns and rows; otherwise None.
+    """
+    if isinstance(value, list) and len(value) == 2:
+        columns, rows = value
+    elif isinstance(value, dict) and "columns" in value and "rows" in value:
+        columns, rows = value["columns"], value["rows"]
+    else:
+        return None
+    if not isinstance(columns, list) or not isinstance(rows, list):
+        return None
+    if not all(isinstance(c, list) and len(c) == 2 for c in columns):
+        return None
+    if not all(isinstance(r, list) and len(r) == len(columns) for r in rows):
+        return None
+    return columns, rows
+
+
+def encode_table(columns, rows):
+    data = {}
+    for index, (attr, _) in enumerate(columns):
+        data[attr] = encode_column([row[index] for row in rows])
+    return {"columns": columns, "length": len(rows), "data": data}
+
+
+def columnar_doc(doc):
+    """
+    Replace the tab2 tables of the yenot payload `doc` (top level or under
+    tables) with column arrays; return the number of tables replaced.
+    """
+    converted = 0
+    containers = [doc]
+    if isinstance(doc.get("tables"), dict):
+        containers.append(doc["tables"])
+    for container in containers:
+        for name, value in list(container.items()):
+            parts = tab2_parts(value)
+            if parts != None:
+                container[name] = encode_table(*parts)
+                converted += 1
+    return converted
+
+
+class ColumnarPlugin:
+    """
+    Rewrite the tab2 json of the lhserver routes as column arrays for the
+    clients accepting CONTENT_TYPE.  The values are those yenot serialized;
+    only the layout changes.
+    """
+
+    name = "lhserver_columnar"
+    api = 2
+
+    def apply(self, callback, route):
+        if not route.callback.__module__.startswith(__package__):
+            return callback
+
+        @functools.wraps(callback)
+        def wrapper(*args, **kwargs):
+            result = callback(*args, **kwargs)
+            if not isinstance(result, (str, bytes)):
+                return result
+            if not wants_columnar(bottle.request):
+                return result
+            try:
+                doc = json.loads(result)
+            except ValueError:
+                return result
+            if not isinstance(doc, dict) or columnar_doc(doc) == 0:
+                return result
+            mark_response()
+            return json.dumps(doc)
+
+        return wrapper
+
+
+app.install(ColumnarPlugin())
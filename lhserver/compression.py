@@ -0,0 +1,119 @@
+import os
+import zlib
+import functools
+import bottle
+import yenot.backend.api as api
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+app = api.get_global_app()
+
+# The lhserver responses are compressed with the best encoding the client
+# accepts of LHSERVER_COMPRESSION (zstd needs the zstandard package).  Whole
+# responses smaller than LHSERVER_COMPRESS_MIN_BYTES are sent as is; streamed
+# responses are compressed and flushed chunk by chunk.
+
+ENCODINGS = [
+    e.strip()
+    for e in os.environ.get("LHSERVER_COMPRESSION", "zstd,gzip").split(",")
+    if e.strip() != "" and (e.strip() != "zstd" or zstandard != None)
+]
+MIN_BYTES = int(os.environ.get("LHSERVER_COMPRESS_MIN_BYTES", 2048))
+GZIP_LEVEL = int(os.environ.get("LHSERVER_GZIP_LEVEL", 6))
+ZSTD_LEVEL = int(os.environ.get("LHSERVER_ZSTD_LEVEL", 3))
+
+
+def accepted_encoding(request):
+    accepted = set()
+    for item in request.headers.get("Accept-Encoding", "").split(","):
+        coding, _, params = item.partition(";")
+        name, _, value = params.partition("=")
+        try:
+            if name.strip() == "q" and float(value) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(coding.strip().lower())
+    for encoding in ENCODINGS:
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+class Compressor:
+    def __init__(self, encoding):
+        if encoding == "zstd":
+            self.cobj = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+            self.flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        else:
+            # wbits 31 is the gzip container
+            self.cobj = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+            self.flush_mode = zlib.Z_SYNC_FLUSH
+
+    def chunk(self, data):
+        return self.cobj.compress(data) + self.cobj.flush(self.flush_mode)
+
+    def finish(self):
+        return self.cobj.flush()
+
+
+def compress(encoding, data):
+    compressor = Compressor(encoding)
+    return compressor.cobj.compress(data) + compressor.finish()
+
+
+def compress_stream(encoding, chunks):
+    compressor = Compressor(encoding)
+    for data in chunks:
+        if isinstance(data, str):
+            data = data.encode("utf8")
+        if len(data) > 0:
+            yield compressor.chunk(data)
+    yield compressor.finish()
+
+
+class CompressionPlugin:
+    name = "lhserver_compression"
+    api = 2
+
+    def apply(self, callback, route):
+        if not route.callback.__module__.startswith(__package__):
+            return callback
+
+        @functools.wraps(callback)
+        def wrapper(*args, **kwargs):
+            result = callback(*args, **kwargs)
+            # the response depends on Accept-Encoding whether or not this
+            # one is compressed
+            if isinstance(result, bottle.HTTPResponse):
+                result.add_header("Vary", "Accept-Encoding")
+                return result
+            bottle.response.add_header("Vary", "Accept-Encoding")
+            encoding = accepted_encoding(bottle.request)
+            if encoding == None:
+                return result
+
+            if isinstance(result, (str, bytes)):
+                data = result.encode("utf8") if isinstance(result, str) else result
+                if len(data) < MIN_BYTES:
+                    return result
+                result = compress(encoding, data)
+            elif hasattr(result, "__next__"):
+                result = compress_stream(encoding, result)
+            else:
+                return result
+            bottle.response.set_header("Content-Encoding", encoding)
+            etag = bottle.response.get_header("ETag")
+            if etag != None and not etag.startswith("W/"):
+                # the compressed bytes are not the entity the strong tag names
+                bottle.response.set_header("ETag", f"W/{etag}")
+            return result
+
+        return wrapper
+
+
+if len(ENCODINGS) > 0:
+    app.install(CompressionPlugin())
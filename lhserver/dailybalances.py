@@ -0,0 +1,231 @@
+import yenot.backend.api as api
+from . import reportcache
+from . import versions
+
+app = api.get_global_app()
+
+# Per-account daily balances are kept in hacc.account_daily_balances with one
+# row per account and date with activity.  The delta column is the net of the
+# splits on that date and cumulative is the running balance through that date
+# so that a balance as of D is the nearest row on or before D.
+
+TRANSACTION_DELTAS = """
+select splits.account_id, transactions.trandate as bal_date,
+    sum(splits.sum)*%(sign)s as delta
+from hacc.splits
+join hacc.transactions on transactions.tid=splits.stid
+where splits.stid=any(%(tids)s::uuid[])
+group by splits.account_id, transactions.trandate
+having sum(splits.sum)<>0
+"""
+
+LEDGER_DAILY_BALANCES = """
+select splits.account_id, transactions.trandate as bal_date,
+    sum(splits.sum) as delta,
+    sum(sum(splits.sum)) over (
+        partition by splits.account_id order by transactions.trandate
+        ) as cumulative
+from hacc.splits
+join hacc.transactions on transactions.tid=splits.stid
+group by splits.account_id, transactions.trandate
+having sum(splits.sum)<>0
+"""
+
+
+ACCOUNT_LOCK = """
+select accounts.id
+from hacc.accounts
+where /*WHERE*/
+order by accounts.id
+for no key update
+"""
+
+
+def lock_accounts(conn, account_ids):
+    """
+    Lock the rows of the accounts `account_ids` (in id order) until commit.
+    Every writer of the balances of an account (daily balances, reconcile
+    statements, period closes) takes this lock first so that concurrent
+    writers of one account are serialized.  It does not block the key share
+    locks of split inserts.
+    """
+    api.sql_void(
+        conn,
+        ACCOUNT_LOCK.replace("/*WHERE*/", "accounts.id=any(%(accounts)s::uuid[])"),
+        {"accounts": sorted(str(a) for a in account_ids)},
+    )
+
+
+def lock_all_accounts(conn):
+    api.sql_void(conn, ACCOUNT_LOCK.replace("/*WHERE*/", "true"))
+
+
+def lock_transaction_accounts(conn, tids, account_ids=()):
+    """
+    Lock the accounts with splits in the transactions `tids` along with the
+    accounts `account_ids` which the caller is about to add splits to; return
+    the locked account ids.
+    """
+    rows = api.sql_rows(
+        conn,
+        "select distinct account_id::text from hacc.splits where stid=any(%(tids)s::uuid[])",
+        {"tids": list(tids)},
+    )
+    accounts = {row.account_id for row in rows}
+    accounts.update(str(a) for a in account_ids if a != None)
+    lock_accounts(conn, accounts)
+    return sorted(accounts)
+
+
+def _apply_deltas(conn, deltas, params):
+    # The new dates get a row seeded with the prior cumulative balance; then
+    # every row on or after a changed date picks up the changes on or before
+    # it.  Rows netting to zero are dropped since they add nothing over the
+    # prior row.  The accounts are locked first so that a concurrent writer
+    # cannot seed or shift the same rows; writers changing several accounts
+    # should lock them all up front with lock_transaction_accounts to keep a
+    # consistent lock order.
+    lock = f"""
+with deltas as (/*DELTAS*/)
+{ACCOUNT_LOCK.replace("/*WHERE*/", "accounts.id in (select account_id from deltas)")}"""
+    insert = """
+with deltas as (/*DELTAS*/)
+insert into hacc.account_daily_balances (account_id, bal_date, delta, cumulative)
+select deltas.account_id, deltas.bal_date, 0, coalesce(prior.cumulative, 0)
+from deltas
+left outer join lateral (
+    select adb.cumulative
+    from hacc.account_daily_balances adb
+    where adb.account_id=deltas.account_id and adb.bal_date<deltas.bal_date
+    order by adb.bal_date desc
+    limit 1
+    ) prior on true
+on conflict (account_id, bal_date) do nothing
+"""
+
+    update = """
+with deltas as (/*DELTAS*/)
+update hacc.account_daily_balances set
+    delta=account_daily_balances.delta+changes.delta,
+    cumulative=account_daily_balances.cumulative+changes.cumulative
+from (
+    select adb.account_id, adb.bal_date,
+        coalesce(sum(deltas.delta) filter (where deltas.bal_date=adb.bal_date), 0) as delta,
+        sum(deltas.delta) as cumulative
+    from hacc.account_daily_balances adb
+    join deltas on deltas.account_id=adb.account_id and deltas.bal_date<=adb.bal_date
+    group by adb.account_id, adb.bal_date
+    ) changes
+where account_daily_balances.account_id=changes.account_id
+    and account_daily_balances.bal_date=changes.bal_date
+"""
+
+    prune = """
+with deltas as (/*DELTAS*/)
+delete from hacc.account_daily_balances adb
+using deltas
+where adb.account_id=deltas.account_id and adb.bal_date=deltas.bal_date
+    and adb.delta=0
+"""
+
+    for statement in [lock, insert, update, prune]:
+        api.sql_void(conn, statement.replace("/*DELTAS*/", deltas), params)
+
+
+def apply_transactions(conn, tids, sign):
+    """
+    Add (sign=1) or remove (sign=-1) the current splits of the transactions
+    `tids` to the daily balances.  Writers call this with -1 before changing a
+    transaction and with 1 after it so the balances change in the same
+    database transaction as the splits.
+    """
+    _apply_deltas(conn, TRANSACTION_DELTAS, {"tids": list(tids), "sign": sign})
+
+
+SPLIT_TRANDATES = [
+    "alter table hacc.splits add column if not exists trandate date",
+    """
+update hacc.splits set trandate=transactions.trandate
+from hacc.transactions
+where tid=stid and splits.trandate is distinct from transactions.trandate""",
+    "alter table hacc.splits alter column trandate set not null",
+    """
+create index if not exists splits_register_idx
+on hacc.splits(account_id, trandate, stid, sid)""",
+    "drop index if exists hacc.splits_account_idx",
+]
+
+
+def rebuild(conn):
+    # ledgers created before splits.trandate get it here
+    for statement in SPLIT_TRANDATES:
+        api.sql_void(conn, statement)
+    api.sql_void(conn, "delete from hacc.account_daily_balances")
+    api.sql_void(
+        conn,
+        f"""
+insert into hacc.account_daily_balances (account_id, bal_date, delta, cumulative)
+{LEDGER_DAILY_BALANCES}""",
+    )
+
+
+@app.put(
+    "/api/gledger/daily-balances/rebuild", name="put_api_gledger_daily_balances_rebuild"
+)
+def put_api_gledger_daily_balances_rebuild():
+    with app.dbconn() as conn:
+        rebuild(conn)
+        versions.bump(conn, ["ledger"])
+        conn.commit()
+    reportcache.clear()
+    return api.Results()
+
+
+def get_api_gledger_daily_balances_verify_prompts():
+    return api.PromptList(__order__=[])
+
+
+@app.get(
+    "/api/gledger/daily-balances/verify",
+    name="get_api_gledger_daily_balances_verify",
+    report_title="Daily Balance Discrepancies",
+    report_prompts=get_api_gledger_daily_balances_verify_prompts,
+)
+def get_api_gledger_daily_balances_verify():
+    select = f"""
+with expected as (
+    {LEDGER_DAILY_BALANCES}
+), mismatch as (
+    select
+        coalesce(expected.account_id, adb.account_id) as account_id,
+        coalesce(expected.bal_date, adb.bal_date) as bal_date,
+        expected.delta as expected_delta,
+        adb.delta as stored_delta,
+        expected.cumulative as expected_cumulative,
+        adb.cumulative as stored_cumulative
+    from expected
+    full outer join hacc.account_daily_balances adb on
+        adb.account_id=expected.account_id and adb.bal_date=expected.bal_date
+    where expected.delta is distinct from adb.delta
+        or expected.cumulative is distinct from adb.cumulative
+)
+select accounts.id, accounts.acc_name, mismatch.bal_date as date,
+    mismatch.expected_delta, mismatch.stored_delta,
+    mismatch.expected_cumulative, mismatch.stored_cumulative
+from mismatch
+join hacc.accounts on accounts.id=mismatch.account_id
+order by accounts.acc_name, mismatch.bal_date
+"""
+
+    results = api.Results(default_title=True)
+    with app.dbconn() as conn:
+        cm = api.ColumnMap(
+            id=api.cgen.pyhacc_account.surrogate(),
+            acc_name=api.cgen.pyhacc_account.name(label="Account", url_key="id"),
+            expected_delta=api.cgen.currency_usd(),
+            stored_delta=api.cgen.currency_usd(),
+            expected_cumulative=api.cgen.currency_usd(),
+            stored_cumulative=api.cgen.currency_usd(),
+        )
+        results.tables["balances", True] = api.sql_tab2(conn, select, None, cm)
+    return results
@@ -1,4 +1,5 @@
 import yenot.backend.api as api
+from . import versions
 
 app = api.get_global_app()
 
@@ -10,14 +11,23 @@ def get_static_settings(request):
     # big nasty global list of every simple combo-boxable list in the entire
     # application.
     settings_map = {
-        "account_types": ("atype_name, id", "hacc.accounttypes", "sort"),
-        "journals": ("jrn_name, id", "hacc.journals", "jrn_name"),
+        "account_types": (
+            "atype_name, id",
+            "hacc.accounttypes",
+            "sort",
+            "accounttypes",
+        ),
+        "journals": ("jrn_name, id", "hacc.journals", "jrn_name", "journals"),
     }
 
     results = api.Results()
     with app.dbconn() as conn:
+        content = {settings_map[v][3] for v in search}
+        notmodified = versions.not_modified(conn, request, content)
+        if notmodified != None:
+            return notmodified
         for v in search:
-            columns, table, sort = settings_map[v]
+            columns, table, sort, _ = settings_map[v]
             select = f"select {columns} from {table} order by {sort}"
             results.tables[v] = api.sql_tab2(conn, select)
-    return results.json_out()
+    return results
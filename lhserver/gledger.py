@@ -1,7 +1,61 @@
+import uuid
 import yenot.backend.api as api
+from . import versions
 
 app = api.get_global_app()
 
+# page size of the transaction list when no date range is given
+TRANSACTIONS_LIST_PAGE = 500
+
+# Transactions whose splits do not sum to zero within a journal are kept in
+# hacc.unbalanced_trans by the transaction writers.
+UNBALANCED_TRANS = """
+insert into hacc.unbalanced_trans (tid, journal_id, unbalance)
+select splits.stid, accounts.journal_id, sum(splits.sum)
+from hacc.splits
+join hacc.accounts on accounts.id=splits.account_id
+where /*WHERE*/
+group by splits.stid, accounts.journal_id
+having sum(splits.sum)<>0
+"""
+
+
+def _refresh_unbalanced(conn, tidset, params):
+    api.sql_void(
+        conn, f"delete from hacc.unbalanced_trans where tid in ({tidset})", params
+    )
+    api.sql_void(
+        conn,
+        UNBALANCED_TRANS.replace("/*WHERE*/", f"splits.stid in ({tidset})"),
+        params,
+    )
+
+
+def refresh_unbalanced(conn, tids):
+    _refresh_unbalanced(conn, "select unnest(%(tids)s::uuid[])", {"tids": list(tids)})
+
+
+def refresh_unbalanced_accounts(conn, account_ids):
+    tidset = "select splits.stid from hacc.splits where splits.account_id=any(%(accounts)s::uuid[])"
+    _refresh_unbalanced(conn, tidset, {"accounts": list(account_ids)})
+
+
+def rebuild_unbalanced(conn):
+    api.sql_void(conn, "delete from hacc.unbalanced_trans")
+    api.sql_void(conn, UNBALANCED_TRANS.replace("/*WHERE*/", "true"))
+
+
+@app.put(
+    "/api/gledger/unbalanced-trans/rebuild",
+    name="put_api_gledger_unbalanced_trans_rebuild",
+)
+def put_api_gledger_unbalanced_trans_rebuild():
+    with app.dbconn() as conn:
+        rebuild_unbalanced(conn)
+        versions.bump(conn, ["ledger"])
+        conn.commit()
+    return api.Results()
+
 
 def get_api_gledger_unbalanced_trans_prompts():
     return api.PromptList(__order__=[])
@@ -17,13 +71,10 @@ def get_api_gledger_unbalanced_trans():
     select = """
 select 
     transactions.tid, transactions.payee, transactions.memo, transactions.trandate, journals.jrn_name, 
-    sum(splits.sum) as unbalance
-from hacc.accounts
-join hacc.splits on splits.account_id=accounts.id
-join hacc.transactions on transactions.tid=splits.stid
-join hacc.journals on journals.id=accounts.journal_id
-group by transactions.tid, transactions.payee, transactions.memo, transactions.trandate, journals.jrn_name
-having sum(splits.sum)<>0
+    unbalanced_trans.unbalance
+from hacc.unbalanced_trans
+join hacc.transactions on transactions.tid=unbalanced_trans.tid
+join hacc.journals on journals.id=unbalanced_trans.journal_id
 """
 
     results = api.Results(default_title=True)
@@ -35,7 +86,7 @@ having sum(splits.sum)<>0
         params = {}
         results.tables["balances", True] = api.sql_tab2(conn, select, params, cm)
 
-    return results.json_out()
+    return results
 
 
 def get_api_transactions_account_summary_prompts():
@@ -110,7 +161,7 @@ group by payee
         results.tables["payee", True] = api.sql_tab2(conn, select, params, cm)
 
     # results.keys['report-formats'] = ['gl_summarize_total']
-    return results.json_out()
+    return results
 
 
 def get_api_transactions_list_prompts():
@@ -134,6 +185,9 @@ def get_api_transactions_list(request):
     date1 = api.parse_date(request.query.get("date1", None))
     date2 = api.parse_date(request.query.get("date2", None))
     fragment = request.query.get("fragment", None)
+    limit = api.parse_int(request.query.get("limit", None))
+    after = request.query.get("after", None)
+    ranked = request.query.get("rank", None) in ["1", "true"]
 
     if date1 == None and date2 == None:
         # both null, no more validation
@@ -148,6 +202,19 @@ def get_api_transactions_list(request):
             "parameter-validation", "Start date must be before end date."
         )
 
+    if limit == None and date1 == None:
+        limit = TRANSACTIONS_LIST_PAGE
+    if limit != None and limit <= 0:
+        raise api.UserError("parameter-validation", "The page size must be positive.")
+    if ranked and fragment in ["", None]:
+        raise api.UserError(
+            "parameter-validation", "A ranked search requires a search fragment."
+        )
+    if ranked and after not in ["", None]:
+        raise api.UserError(
+            "parameter-validation", "A ranked search returns only the first page."
+        )
+
     select = """
 select
     transactions.tid, transactions.trandate,
@@ -155,21 +222,10 @@ select
     transactions.payee, transactions.memo,
     details.accounts
 from hacc.transactions
-join lateral (
-    with raw as (
-        select accounts.acc_name
-        from hacc.splits
-        join hacc.accounts on splits.account_id=accounts.id
-        join hacc.accounttypes on accounttypes.id=accounts.type_id
-        where splits.stid=transactions.tid
-        group by accounts.acc_name, accounttypes.sort
-        order by abs(sum(splits.sum)) desc, accounttypes.sort, accounts.acc_name
-    )
-    select array_agg(acc_name) as accounts
-    from raw
-    ) details on true
+left outer join hacc.transaction_accounts details on details.tid=transactions.tid
 /*WHERE*/
-order by trandate desc
+/*ORDER*/
+/*LIMIT*/
 """
 
     params = {}
@@ -189,6 +245,38 @@ order by trandate desc
         )
         results.key_labels += f'Containing "{fragment}"'
 
+    if ranked:
+        # best match of the fragment against the words of payee or memo;
+        # the ilike filter above narrows through the trigram indexes first
+        params["fragtext"] = fragment
+        order = """order by greatest(
+        word_similarity(%(fragtext)s, coalesce(transactions.payee, '')),
+        word_similarity(%(fragtext)s, coalesce(transactions.memo, ''))) desc,
+    transactions.trandate desc, transactions.tid"""
+    else:
+        order = "order by transactions.trandate desc, transactions.tid"
+    select = select.replace("/*ORDER*/", order)
+
+    if after not in ["", None]:
+        # keyset cursor of the last row of the prior page; the plain bound on
+        # trandate lets the planner range scan the trandate index
+        cdate, _, ctid = after.partition("/")
+        try:
+            params["cdate"] = api.parse_date(cdate)
+            params["ctid"] = str(uuid.UUID(ctid))
+        except ValueError:
+            params["cdate"] = None
+        if params["cdate"] == None:
+            raise api.UserError("parameter-validation", "Invalid page cursor.")
+        wheres.append(
+            "transactions.trandate<=%(cdate)s and (transactions.trandate<%(cdate)s or (transactions.trandate=%(cdate)s and transactions.tid>%(ctid)s))"
+        )
+
+    if limit != None:
+        # one extra row tells if there is another page
+        params["limit"] = limit + 1
+        select = select.replace("/*LIMIT*/", "limit %(limit)s")
+
     if len(wheres) > 0:
         whstr = "where " + " and ".join(wheres)
     else:
@@ -203,6 +291,13 @@ order by trandate desc
             trandate=api.cgen.auto(label="Date"),
             accounts=api.cgen.stringlist(),
         )
-        results.tables["trans", True] = api.sql_tab2(conn, select, params, cm)
+        columns, rows = api.sql_tab2(conn, select, params, cm)
+
+    if limit != None and len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        if not ranked:
+            results.keys["next-cursor"] = f"{last.trandate}/{last.tid}"
+    results.tables["trans", True] = columns, rows
 
-    return results.json_out()
+    return results
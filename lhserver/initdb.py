@@ -1,12 +1,50 @@
+import threading
 import yenot.backend.api as api
 
 
 TAG_BANK_PENDING = "Bank Pending"
 TAG_BANK_RECONCILED = "Bank Reconciled"
 
+SYSTEM_TAGS = [TAG_BANK_PENDING, TAG_BANK_RECONCILED]
+
+
+class TagRegistry:
+    """
+    Process wide map of the system tag names to their ids.  The tags are
+    written once by the data init and the server does not change them, so the
+    ids are read on first use and kept.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = None
+
+    def tag_ids(self, conn):
+        with self.lock:
+            if self.ids == None:
+                rows = api.sql_rows(
+                    conn,
+                    "select tag_name, id from hacc.tags where tag_name=any(%(t)s)",
+                    {"t": SYSTEM_TAGS},
+                )
+                ids = {row.tag_name: str(row.id) for row in rows}
+                missing = [tag for tag in SYSTEM_TAGS if tag not in ids]
+                if len(missing) > 0:
+                    raise api.UserError(
+                        "data-check", f"System tags are missing:  {', '.join(missing)}"
+                    )
+                self.ids = ids
+            return self.ids
+
+    def tag_id(self, conn, tag_name):
+        return self.tag_ids(conn)[tag_name]
+
+
+system_tags = TagRegistry()
+
 
 def yenot_lmshacc_data_init(conn, args):
-    for tag in [TAG_BANK_PENDING, TAG_BANK_RECONCILED]:
+    for tag in SYSTEM_TAGS:
         api.sql_void(
             conn, "insert into hacc.tags (tag_name) values (%(t)s)", {"t": tag}
         )
@@ -1,5 +1,7 @@
 import uuid
 import yenot.backend.api as api
+from . import reportcache
+from . import versions
 
 app = api.get_global_app()
 
@@ -7,19 +9,22 @@ app = api.get_global_app()
 @app.get(
     "/api/journals/list", name="get_api_journals_list", report_title="Journals List"
 )
-def get_api_journals_list():
+def get_api_journals_list(request):
     select = """
 select *
 from hacc.journals"""
 
     results = api.Results(default_title=True)
     with app.dbconn() as conn:
+        notmodified = versions.not_modified(conn, request, ["journals"])
+        if notmodified != None:
+            return notmodified
         cm = api.ColumnMap(
             id=api.cgen.pyhacc_journal.surrogate(),
             jrn_name=api.cgen.pyhacc_journal.name(label="Journal", url_key="id"),
         )
         results.tables["journals", True] = api.sql_tab2(conn, select, column_map=cm)
-    return results.json_out()
+    return results
 
 
 def _api_journal(jrn_id):
@@ -53,13 +58,13 @@ where /*WHERE*/"""
 @app.get("/api/journal/new", name="get_api_journal_new")
 def api_journal_new():
     results = _api_journal("new")
-    return results.json_out()
+    return results
 
 
 @app.get("/api/journal/<jrn_id>", name="get_api_journal")
 def api_journal(jrn_id):
     results = _api_journal(jrn_id)
-    return results.json_out()
+    return results
 
 
 @app.put("/api/journal/<jrn_id>", name="put_api_journal")
@@ -69,6 +74,8 @@ def put_journal(jrn_id):
     with app.dbconn() as conn:
         with api.writeblock(conn) as w:
             w.upsert_rows("hacc.journals", jrn)
+        versions.bump(conn, ["journals", "ledger"])
         conn.commit()
+    reportcache.clear()
 
-    return api.Results().json_out()
+    return api.Results()
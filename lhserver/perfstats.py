@@ -0,0 +1,280 @@
+import os
+import time
+import collections
+import contextlib
+import functools
+import threading
+import bottle
+import psycopg2.extensions
+import rtlib
+import yenot.backend.api as api
+
+app = api.get_global_app()
+
+# Every lhserver route is timed by a bottle plugin.  While a route runs, the
+# connections it takes from app.dbconn make their cursors with a timing
+# subclass of their cursor factory which adds each statement (and the fetches
+# of its rows) to the request being served on the thread.  The routes return
+# their api.Results to the plugin, which times the serialization.  The
+# lhserver row transforms mark themselves with `phase`.  The most recent
+# SAMPLES timings of each route are kept for percentiles.  Streamed responses
+# do their work after the route returns and are not timed.
+#
+# LHSERVER_PERF_HEADER=1 adds a Server-Timing header to the responses.
+
+SAMPLES = 1000
+TIMING_HEADER = os.environ.get("LHSERVER_PERF_HEADER", "") not in ["", "0"]
+PHASES = ["transform", "serialize"]
+
+
+class RequestTiming:
+    def __init__(self):
+        self.queries = []
+        self.rows = 0
+        self.phases = {name: 0.0 for name in PHASES}
+
+    @property
+    def sql(self):
+        return sum(self.queries)
+
+
+class PerfStats:
+    def __init__(self, samples):
+        self.samples = samples
+        self.routes = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def current(self):
+        return getattr(self.local, "timing", None)
+
+    def record(self, route, total, timing):
+        sample = (
+            total,
+            timing.sql,
+            len(timing.queries),
+            max(timing.queries, default=0.0),
+            *[timing.phases[name] for name in PHASES],
+            timing.rows,
+        )
+        with self.lock:
+            if route not in self.routes:
+                self.routes[route] = collections.deque(maxlen=self.samples)
+            self.routes[route].append(sample)
+
+    def snapshot(self):
+        with self.lock:
+            return {route: list(samples) for route, samples in self.routes.items()}
+
+    def reset(self):
+        with self.lock:
+            self.routes.clear()
+
+
+stats = PerfStats(SAMPLES)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """
+    Add the time of the with block to the phase `name` of the current request.
+    """
+    timing = stats.current()
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timing != None:
+            timing.phases[name] += time.perf_counter() - t0
+
+
+class TimingCursorMixin:
+    """
+    Time the statements of a cursor; the fetches add to the time of the last
+    statement since a server side cursor does its work as it is fetched.
+    """
+
+    def _statement(self, method, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            timing = stats.current()
+            if timing != None:
+                timing.queries.append(time.perf_counter() - t0)
+
+    def _fetch(self, method, *args):
+        t0 = time.perf_counter()
+        rows = method(*args)
+        timing = stats.current()
+        if timing != None:
+            if len(timing.queries) > 0:
+                timing.queries[-1] += time.perf_counter() - t0
+            if isinstance(rows, list):
+                timing.rows += len(rows)
+            elif rows != None:
+                timing.rows += 1
+        return rows
+
+    def execute(self, *args, **kwargs):
+        return self._statement(super().execute, *args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self._statement(super().executemany, *args, **kwargs)
+
+    def callproc(self, *args, **kwargs):
+        return self._statement(super().callproc, *args, **kwargs)
+
+    def copy_expert(self, *args, **kwargs):
+        return self._statement(super().copy_expert, *args, **kwargs)
+
+    def fetchone(self):
+        return self._fetch(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self._fetch(super().fetchmany, *args)
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+    def __iter__(self):
+        for row in super().__iter__():
+            timing = stats.current()
+            if timing != None:
+                timing.rows += 1
+            yield row
+
+
+_timing_factories = {}
+
+
+def timing_cursor_factory(base):
+    if base == None:
+        base = psycopg2.extensions.cursor
+    if base not in _timing_factories:
+        _timing_factories[base] = type(
+            f"Timing{base.__name__}", (TimingCursorMixin, base), {}
+        )
+    return _timing_factories[base]
+
+
+class PerfStatsPlugin:
+    name = "lhserver_perfstats"
+    api = 2
+
+    def setup(self, app):
+        dbconn = app.dbconn
+
+        @contextlib.contextmanager
+        def timed_dbconn(*args, **kwargs):
+            with dbconn(*args, **kwargs) as conn:
+                if stats.current() == None:
+                    yield conn
+                    return
+                # the connection goes back to the pool with its own factory
+                base = conn.cursor_factory
+                conn.cursor_factory = timing_cursor_factory(base)
+                try:
+                    yield conn
+                finally:
+                    conn.cursor_factory = base
+
+        app.dbconn = timed_dbconn
+
+    def apply(self, callback, route):
+        if not route.callback.__module__.startswith(__package__):
+            return callback
+
+        @functools.wraps(callback)
+        def wrapper(*args, **kwargs):
+            timing = RequestTiming()
+            stats.local.timing = timing
+            t0 = time.perf_counter()
+            try:
+                result = callback(*args, **kwargs)
+                if isinstance(result, api.Results):
+                    with phase("serialize"):
+                        result = result.json_out()
+            finally:
+                total = time.perf_counter() - t0
+                stats.local.timing = None
+            if hasattr(result, "__next__"):
+                return result
+            stats.record(route.name or route.rule, total, timing)
+            if TIMING_HEADER:
+                header = server_timing(total, timing)
+                bottle.response.set_header("Server-Timing", header)
+            return result
+
+        return wrapper
+
+
+def server_timing(total, timing):
+    parts = [("sql", timing.sql)]
+    parts += [(name, timing.phases[name]) for name in PHASES]
+    parts.append(("total", total))
+    return ", ".join(f"{name};dur={secs * 1000:.1f}" for name, secs in parts)
+
+
+app.install(PerfStatsPlugin())
+
+
+def percentile_ms(values, p):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(p * len(values)))] * 1000, 1)
+
+
+def get_api_hacc_perf_stats_prompts():
+    return api.PromptList(__order__=[])
+
+
+@app.get(
+    "/api/hacc/perf-stats",
+    name="get_api_hacc_perf_stats",
+    report_title="Route Performance",
+    report_prompts=get_api_hacc_perf_stats_prompts,
+)
+def get_api_hacc_perf_stats():
+    columns = [
+        ("route", api.cgen.auto()),
+        ("count", api.cgen.auto()),
+        ("total_p50", api.cgen.auto(label="Total p50 (ms)")),
+        ("total_p90", api.cgen.auto(label="Total p90 (ms)")),
+        ("total_p99", api.cgen.auto(label="Total p99 (ms)")),
+        ("sql_p50", api.cgen.auto(label="SQL p50 (ms)")),
+        ("sql_p90", api.cgen.auto(label="SQL p90 (ms)")),
+        ("queries", api.cgen.auto(label="Queries (mean)")),
+        ("slowest_p90", api.cgen.auto(label="Slowest Query p90 (ms)")),
+        ("transform_p50", api.cgen.auto(label="Transform p50 (ms)")),
+        ("serialize_p50", api.cgen.auto(label="Serialize p50 (ms)")),
+        ("serialize_p90", api.cgen.auto(label="Serialize p90 (ms)")),
+        ("rows", api.cgen.auto(label="Rows (mean)")),
+    ]
+    rtable = rtlib.ClientTable(columns, [])
+    for route, samples in sorted(stats.snapshot().items()):
+        total, sql, queries, slowest, transform, serialize, rows = zip(*samples)
+        with rtable.adding_row() as row:
+            row.route = route
+            row.count = len(samples)
+            row.total_p50 = percentile_ms(total, 0.5)
+            row.total_p90 = percentile_ms(total, 0.9)
+            row.total_p99 = percentile_ms(total, 0.99)
+            row.sql_p50 = percentile_ms(sql, 0.5)
+            row.sql_p90 = percentile_ms(sql, 0.9)
+            row.queries = round(sum(queries) / len(samples), 1)
+            row.slowest_p90 = percentile_ms(slowest, 0.9)
+            row.transform_p50 = percentile_ms(transform, 0.5)
+            row.serialize_p50 = percentile_ms(serialize, 0.5)
+            row.serialize_p90 = percentile_ms(serialize, 0.9)
+            row.rows = round(sum(rows) / len(samples), 1)
+
+    results = api.Results(default_title=True)
+    cm = {attr: values for attr, values in columns}
+    results.tables["routes", True] = rtable.as_tab2(column_map=cm)
+    return results
+
+
+@app.delete("/api/hacc/perf-stats", name="delete_api_hacc_perf_stats")
+def delete_api_hacc_perf_stats():
+    stats.reset()
+    return api.Results()
@@ -1,17 +1,57 @@
 import datetime
-import rtlib
 import yenot.backend.api as api
 from . import shared
 from . import bankday
+from . import reportcache
+from . import streaming
 
 app = api.get_global_app()
 
 
-def dcb_values(debit, debit_amt):
-    d = debit_amt if debit else None
-    c = -debit_amt if not debit else None
-    b = debit_amt * (1 if debit else -1) if debit_amt != None else None
-    return d, c, b
+# The activity between two dates is the difference of the daily balance
+# cumulatives on each side so the cost does not depend on the number of splits
+# in the period (or before it).
+PROFIT_AND_LOSS_D1_D2 = f"""
+with deltas as (
+    select accounts.id as account_id,
+        coalesce(bal2.cumulative, 0)-coalesce(bal1.cumulative, 0) as debit
+    from hacc.accounts
+    join hacc.accounttypes on accounttypes.id=accounts.type_id
+    left outer join lateral (
+        select account_daily_balances.cumulative
+        from hacc.account_daily_balances
+        where account_daily_balances.account_id=accounts.id
+            and account_daily_balances.bal_date<=%(d2)s
+        order by account_daily_balances.bal_date desc
+        limit 1
+        ) bal2 on true
+    left outer join lateral (
+        select account_daily_balances.cumulative
+        from hacc.account_daily_balances
+        where account_daily_balances.account_id=accounts.id
+            and account_daily_balances.bal_date<%(d1)s
+        order by account_daily_balances.bal_date desc
+        limit 1
+        ) bal1 on true
+    where not accounttypes.balance_sheet
+        and coalesce(bal2.cumulative, 0)<>coalesce(bal1.cumulative, 0)
+)
+select
+    accounttypes.id as atype_id,
+    accounttypes.atype_name, 
+    accounttypes.sort as atype_sort,
+    accounttypes.debit as debit_account, 
+    journals.id as jrn_id,
+    journals.jrn_name, 
+    accounts.id, accounts.acc_name, 
+    accounts.description,
+    {shared.debit_credit_balance("deltas.debit", "accounttypes.debit")}
+from deltas
+join hacc.accounts on accounts.id=deltas.account_id
+join hacc.accounttypes on accounttypes.id=accounts.type_id
+join hacc.journals on journals.id=accounts.journal_id
+order by accounttypes.sort, journals.jrn_name
+"""
 
 
 def api_gledger_profit_and_loss_prompts():
@@ -32,38 +72,12 @@ def api_gledger_profit_and_loss_prompts():
     report_prompts=api_gledger_profit_and_loss_prompts,
     report_sidebars=shared.account_sidebar("id"),
 )
+@reportcache.cached(span=reportcache.span_date1_date2)
 def api_gledger_profit_and_loss(request):
     date1 = api.parse_date(request.query.get("date1"))
     date2 = api.parse_date(request.query.get("date2"))
 
-    select = """
-with deltas as (
-    select accounts.id as account_id, sum(splits.sum) as debit
-    from hacc.transactions
-    join hacc.splits on transactions.tid=splits.stid
-    join hacc.accounts on splits.account_id=accounts.id
-    join hacc.accounttypes on accounttypes.id=accounts.type_id
-    where transactions.trandate between %(d1)s and %(d2)s 
-        and not accounttypes.balance_sheet
-    group by accounts.id, accounts.type_id
-    having sum(splits.sum)<>0
-)
-select
-    accounttypes.id as atype_id,
-    accounttypes.atype_name, 
-    accounttypes.sort as atype_sort,
-    accounttypes.debit as debit_account, 
-    journals.id as jrn_id,
-    journals.jrn_name, 
-    accounts.id, accounts.acc_name, 
-    accounts.description,
-    deltas.debit
-from deltas
-join hacc.accounts on accounts.id=deltas.account_id
-join hacc.accounttypes on accounttypes.id=accounts.type_id
-join hacc.journals on journals.id=accounts.journal_id
-order by accounttypes.sort, journals.jrn_name
-"""
+    select = PROFIT_AND_LOSS_D1_D2
 
     params = {"d1": date1, "d2": date2}
     results = api.Results(default_title=True)
@@ -86,24 +100,10 @@ order by accounttypes.sort, journals.jrn_name
             credit=api.cgen.currency_usd(hidden=True),
             balance=api.cgen.currency_usd(),
         )
-        data = api.sql_tab2(conn, select, params, cm)
-
-        columns = api.tab2_columns_transform(
-            data[0], insert=[("debit", "credit", "balance")], column_map=cm
-        )
-
-        def transform_dc(oldrow, row):
-            d, c, b = dcb_values(row.debit_account, row.debit)
-            row.debit = d
-            row.credit = c
-            row.balance = b
-
-        rows = api.tab2_rows_transform(data, columns, transform_dc)
-
-        results.tables["deltas", True] = columns, rows
+        results.tables["deltas", True] = api.sql_tab2(conn, select, params, cm)
 
     results.keys["report-formats"] = ["gl_summarize_by_type"]
-    return results.json_out()
+    return results
 
 
 def get_api_gledger_interval_p_and_l_prompts():
@@ -126,6 +126,7 @@ def get_api_gledger_interval_p_and_l_prompts():
     report_prompts=get_api_gledger_interval_p_and_l_prompts,
     report_sidebars=shared.account_sidebar("id"),
 )
+@reportcache.cached(span=reportcache.span_interval_p_and_l)
 def get_api_gledger_interval_p_and_l(request):
     edate = api.parse_date(request.query.get("ending_date"))
     intervals = api.parse_int(request.query.get("intervals"))
@@ -133,15 +134,14 @@ def get_api_gledger_interval_p_and_l(request):
 
     select = """
 with deltas as (
-    select accounts.id as account_id, sum(splits.sum) as debit
-    from hacc.transactions
-    join hacc.splits on transactions.tid=splits.stid
-    join hacc.accounts on splits.account_id=accounts.id
+    select account_daily_balances.account_id,
+        /*INTERVAL_SUMS*/
+    from hacc.account_daily_balances
+    join hacc.accounts on accounts.id=account_daily_balances.account_id
     join hacc.accounttypes on accounttypes.id=accounts.type_id
-    where transactions.trandate between %(d1)s and %(d2)s 
+    where account_daily_balances.bal_date between %(dmin)s and %(dmax)s
         and not accounttypes.balance_sheet
-    group by accounts.id, accounts.type_id
-    having sum(splits.sum)<>0
+    group by account_daily_balances.account_id
 )
 select
     accounttypes.id as atype_id,
@@ -152,12 +152,13 @@ select
     journals.jrn_name, 
     accounts.id, accounts.acc_name, 
     accounts.description,
-    deltas.debit
+    /*INTERVAL_DCB*/
 from deltas
 join hacc.accounts on accounts.id=deltas.account_id
 join hacc.accounttypes on accounttypes.id=accounts.type_id
 join hacc.journals on journals.id=accounts.journal_id
-order by accounttypes.sort, journals.jrn_name
+where coalesce(/*INTERVAL_DEBITS*/) is not null
+order by accounttypes.sort, accounts.acc_name
 """
 
     ed1 = datetime.date(edate.year, edate.month, 1)
@@ -167,20 +168,37 @@ order by accounttypes.sort, journals.jrn_name
         dcurr = bankday.n_months_earlier(ed1, index * length)
         date_ranges.append((dprior, bankday.month_end(dcurr)))
 
+    # Every interval is a filtered sum in one pass over the daily balances
+    # spanning all the intervals.
+    params = {
+        "dmin": min(d1 for d1, _ in date_ranges),
+        "dmax": max(d2 for _, d2 in date_ranges),
+    }
+    sums_list = []
+    dcb_list = []
+    debits_list = []
+    for index, dates in enumerate(date_ranges):
+        n = index + 1
+        params[f"d1_{n}"], params[f"d2_{n}"] = dates
+        sums_list.append(
+            f"nullif(sum(account_daily_balances.delta) filter (where account_daily_balances.bal_date between %(d1_{n})s and %(d2_{n})s), 0) as debit_{n}"
+        )
+        dcb_list.append(
+            shared.debit_credit_balance(
+                f"deltas.debit_{n}", "accounttypes.debit", suffix=f"_{n}"
+            )
+        )
+        debits_list.append(f"deltas.debit_{n}")
+
+    select = (
+        select.replace("/*INTERVAL_SUMS*/", ",\n\t".join(sums_list))
+        .replace("/*INTERVAL_DCB*/", ",\n\t".join(dcb_list))
+        .replace("/*INTERVAL_DEBITS*/", ", ".join(debits_list))
+    )
+
     results = api.Results(default_title=True)
     results.key_labels += f"Date:  {date_ranges[0][0]} -- {date_ranges[-1][1]}"
     with app.dbconn() as conn:
-        intervals = [
-            api.sql_rows(conn, select, {"d1": d1, "d2": d2}) for d1, d2 in date_ranges
-        ]
-
-        accounts = {}
-        intsets = []
-        for rowset in intervals:
-            thing = {row.id: row for row in rowset}
-            intsets.append(thing)
-            accounts.update(thing)
-
         columns = [
             ("atype_id", api.cgen.pyhacc_accounttype.surrogate()),
             (
@@ -216,37 +234,12 @@ order by accounttypes.sort, journals.jrn_name
                     api.cgen.currency_usd(label=f"Balance\n{d2}"),
                 ),
             ]
-        columns = shared.hacc_columns(columns)
-
-        accrefs = list(accounts.values())
-        accrefs.sort(key=lambda x: (x.atype_sort, x.acc_name))
 
-        rtable = rtlib.ClientTable(columns, [])
-
-        for acc in accrefs:
-            with rtable.adding_row() as row:
-                row.id = acc.id
-                row.acc_name = acc.acc_name
-                row.description = acc.description
-                row.atype_sort = acc.atype_sort
-                row.debit_account = acc.debit_account
-                row.atype_id = acc.atype_id
-                row.atype_name = acc.atype_name
-                row.jrn_id = acc.jrn_id
-                row.jrn_name = acc.jrn_name
-                for index, iset in enumerate(intsets):
-                    arow = iset.get(acc.id, None)
-                    if arow != None:
-                        d, c, b = dcb_values(arow.debit_account, arow.debit)
-                        setattr(row, f"debit_{index + 1}", d)
-                        setattr(row, f"credit_{index + 1}", c)
-                        setattr(row, f"balance_{index + 1}", b)
-
-        cm = {attr: values for attr, values in columns}
-        results.tables["balances", True] = rtable.as_tab2(column_map=cm)
+        cm = shared.HaccColumnMap(**dict(columns))
+        results.tables["balances", True] = api.sql_tab2(conn, select, params, cm)
 
     results.keys["report-formats"] = ["gl_summarize_by_type"]
-    return results.json_out()
+    return results
 
 
 def get_api_gledger_detailed_pl_prompts():
@@ -263,6 +256,7 @@ def get_api_gledger_detailed_pl_prompts():
     report_title="Detailed Profit & Loss",
     report_prompts=get_api_gledger_detailed_pl_prompts,
 )
+@reportcache.cached(span=reportcache.span_date1_date2)
 def get_api_gledger_detailed_pl(request):
     date1 = api.parse_date(request.query.get("date1"))
     date2 = api.parse_date(request.query.get("date2"))
@@ -303,22 +297,24 @@ order by accounttypes.sort, transactions.trandate,
 
     results = api.Results(default_title=True)
     results.key_labels += f"Period between: {date1} -- {date2}"
+    results.keys["report-formats"] = ["gl_summarize_by_type"]
+    cm = shared.HaccColumnMap(
+        tid=api.cgen.pyhacc_transaction.surrogate(row_url_label="Transaction"),
+        atype_sort=api.cgen.auto(hidden=True),
+        atype_id=api.cgen.pyhacc_accounttype.surrogate(),
+        atype_name=api.cgen.pyhacc_accounttype.name(
+            label="Account Type", url_key="atype_id", sort_proxy="atype_sort"
+        ),
+        id=api.cgen.pyhacc_account.surrogate(),
+        acc_name=api.cgen.pyhacc_account.name(url_key="id", label="Account"),
+        jrn_id=api.cgen.pyhacc_journal.surrogate(),
+        jrn_name=api.cgen.pyhacc_journal.name(url_key="jrn_id", label="Journal"),
+        debit=api.cgen.currency_usd(widget_kwargs={"blankzero": True}),
+        credit=api.cgen.currency_usd(widget_kwargs={"blankzero": True}),
+    )
+    if streaming.wants_stream(request):
+        return streaming.stream_tab2(results, "trans", select, params, cm)
+
     with app.dbconn() as conn:
-        cm = shared.HaccColumnMap(
-            tid=api.cgen.pyhacc_transaction.surrogate(row_url_label="Transaction"),
-            atype_sort=api.cgen.auto(hidden=True),
-            atype_id=api.cgen.pyhacc_accounttype.surrogate(),
-            atype_name=api.cgen.pyhacc_accounttype.name(
-                label="Account Type", url_key="atype_id", sort_proxy="atype_sort"
-            ),
-            id=api.cgen.pyhacc_account.surrogate(),
-            acc_name=api.cgen.pyhacc_account.name(url_key="id", label="Account"),
-            jrn_id=api.cgen.pyhacc_journal.surrogate(),
-            jrn_name=api.cgen.pyhacc_journal.name(url_key="jrn_id", label="Journal"),
-            debit=api.cgen.currency_usd(widget_kwargs={"blankzero": True}),
-            credit=api.cgen.currency_usd(widget_kwargs={"blankzero": True}),
-        )
         results.tables["trans", True] = api.sql_tab2(conn, select, params, cm)
-
-    results.keys["report-formats"] = ["gl_summarize_by_type"]
-    return results.json_out()
+    return results
@@ -1,35 +1,150 @@
 import yenot.backend.api as api
+from . import shared
 from . import initdb
+from . import versions
+from . import dailybalances
+from . import reportcache
 
 app = api.get_global_app()
 
 
-def dcb_values(debit, debit_amt):
-    if debit_amt == None:
-        return None, None, None
-    if debit_amt > 0.0:
-        d = debit_amt
-        c = None
-    elif debit_amt < 0.0:
-        d = None
-        c = -debit_amt
+RECONCILED_SUM = """
+select coalesce(sum(splits.sum), 0.0)
+from hacc.splits
+join hacc.tagsplits tsrec on tsrec.split_id=splits.sid and 
+                    tsrec.tag_id=%(brec)s
+where splits.account_id=%(account)s"""
+
+
+def reconciled_sums(conn, tids):
+    """
+    Return the reconciled amount of the transactions `tids` by account.
+    Transaction writers compare this before and after a write to find the
+    accounts whose reconciliation statements no longer add up; they hold the
+    locks of the accounts (dailybalances.lock_transaction_accounts) from
+    before the first call so that no reconciliation comes in between.
+    """
+    select = """
+select splits.account_id, sum(splits.sum) as reconciled
+from hacc.splits
+join hacc.tagsplits tsrec on tsrec.split_id=splits.sid and 
+                    tsrec.tag_id=%(brec)s
+where splits.stid=any(%(tids)s::uuid[])
+group by splits.account_id"""
+
+    brec = initdb.system_tags.tag_id(conn, initdb.TAG_BANK_RECONCILED)
+    rows = api.sql_rows(conn, select, {"brec": brec, "tids": list(tids)})
+    return {str(row.account_id): row.reconciled for row in rows}
+
+
+def version_names(account_ids):
+    """
+    Return the content version names of the reconciliations of the accounts
+    `account_ids`; the writers of the splits of an account bump them with the
+    ledger so that an open reconciliation of the account is refused.
+    """
+    return [f"reconcile.{account_id}" for account_id in account_ids]
+
+
+def account_version(conn, account_id):
+    (name,) = version_names([account_id])
+    return versions.current(conn, [name])[name]
+
+
+def invalidate_statements(conn, before, after):
+    accounts = [
+        account
+        for account in set(before).union(after)
+        if before.get(account, 0) != after.get(account, 0)
+    ]
+    if len(accounts) > 0:
+        api.sql_void(
+            conn,
+            """
+update hacc.reconcile_statements set stale=true
+where account_id=any(%(accounts)s::uuid[]) and not stale""",
+            {"accounts": accounts},
+        )
+
+
+def _write_statement(conn, params, statement_date, changes):
+    """
+    Record the reconciled `changes` on the account's statement of
+    `statement_date`.  The saves of a statement (each toggle in delta mode)
+    update the latest valid statement in place when it is of the same date;
+    a split toggled back cancels its earlier change.
+    """
+    prior = api.sql_1row(
+        conn,
+        """
+select id, statement_date, reconciled_balance
+from hacc.reconcile_statements
+where account_id=%(account)s and not stale
+order by id desc
+limit 1""",
+        params,
+    )
+    delta = sum(row.sum if row.reconciled else -row.sum for row in changes)
+    if prior != None and prior.statement_date == statement_date:
+        statement_id = prior.id
+        api.sql_void(
+            conn,
+            """
+update hacc.reconcile_statements set reconciled_balance=reconciled_balance+%(d)s
+where id=%(s)s""",
+            {"s": statement_id, "d": delta},
+        )
     else:
-        d = 0.0 if debit else None
-        c = 0.0 if not debit else None
-    b = debit_amt * (1 if debit else -1) if debit_amt != None else None
-    return d, c, b
+        if prior == None:
+            # first (or first valid) statement starts from the full history
+            balance = api.sql_1row(conn, RECONCILED_SUM, params)
+        else:
+            balance = prior.reconciled_balance + delta
+        statement_id = api.sql_1row(
+            conn,
+            """
+insert into hacc.reconcile_statements (account_id, statement_date, reconciled_balance)
+values (%(account)s, %(sd)s, %(bal)s)
+returning id""",
+            {"account": params["account"], "sd": statement_date, "bal": balance},
+        )
+    api.sql_void(
+        conn,
+        """
+with changes as (
+    select *
+    from unnest(%(sids)s::uuid[], %(flags)s::boolean[]) as changes(split_id, reconciled)
+), cancelled as (
+    delete from hacc.reconcile_statement_splits rss
+    using changes
+    where rss.statement_id=%(s)s and rss.split_id=changes.split_id
+        and rss.reconciled<>changes.reconciled
+    returning rss.split_id
+)
+insert into hacc.reconcile_statement_splits (statement_id, split_id, reconciled)
+select %(s)s, changes.split_id, changes.reconciled
+from changes
+where changes.split_id not in (select split_id from cancelled)
+on conflict (statement_id, split_id) do nothing""",
+        {
+            "s": statement_id,
+            "sids": [str(row.split_id) for row in changes],
+            "flags": [row.reconciled for row in changes],
+        },
+    )
 
 
 @app.get("/api/transactions/reconcile", name="get_api_transactions_reconcile")
 def get_api_transactions_reconcile(request):
     account = request.query.get("account")
 
-    select = """
+    dcb = shared.debit_credit_balance("splits.sum", "atype.debit", by_sign=True)
+    select = f"""
 select
     splits.sid,
     tspend.split_id is not null as pending,
     tsrec.split_id is not null as reconciled,
-    splits.sum as debit,
+    {dcb},
     transactions.tid,
     transactions.trandate as date,
     transactions.tranref as reference,
@@ -37,10 +152,12 @@ select
     transactions.memo
 from hacc.splits
 left outer join hacc.tagsplits tspend on tspend.split_id=splits.sid and 
-                    tspend.tag_id=(select id from hacc.tags where tag_name=%(bpend)s)
+                    tspend.tag_id=%(bpend)s
 left outer join hacc.tagsplits tsrec on tsrec.split_id=splits.sid and 
-                    tsrec.tag_id=(select id from hacc.tags where tag_name=%(brec)s)
+                    tsrec.tag_id=%(brec)s
 join hacc.transactions on splits.stid=transactions.tid
+join hacc.accounts on accounts.id=splits.account_id
+join hacc.accounttypes atype on atype.id=accounts.type_id
 where splits.account_id=%(account)s and tsrec.split_id is null
 """
 
@@ -49,29 +166,42 @@ select
     accounts.id, accounts.acc_name,
     accounts.rec_note,
     atype.debit as debit_account,
-    coalesce(reconciled.summary, 0.0) * (case when atype.debit then 1 else -1 end) as prior_reconciled_balance
+    coalesce(statement.reconciled_balance, reconciled.summary, 0.0) * (case when atype.debit then 1 else -1 end) as prior_reconciled_balance
 from hacc.accounts
 join hacc.accounttypes atype on atype.id=accounts.type_id
 left outer join lateral (
+    select reconcile_statements.reconciled_balance
+    from hacc.reconcile_statements
+    where reconcile_statements.account_id=accounts.id
+        and not reconcile_statements.stale
+    order by reconcile_statements.id desc
+    limit 1
+    ) statement on true
+left outer join lateral (
+    -- full history only when there is no valid statement
     select sum(splits.sum) as summary
     from hacc.splits
     join hacc.tagsplits tsrec on tsrec.split_id=splits.sid and 
-                        tsrec.tag_id=(select id from hacc.tags where tag_name=%(brec)s)
+                        tsrec.tag_id=%(brec)s
     where splits.account_id=accounts.id
+        and statement.reconciled_balance is null
     ) reconciled on true
 where accounts.id=%(account)s"""
 
     results = api.Results(default_title=True)
     with app.dbconn() as conn:
+        # read before the splits so a write committing in between makes the
+        # page stale rather than the version newer than the page
+        results.keys["reconcile-version"] = account_version(conn, account)
+        tags = initdb.system_tags.tag_ids(conn)
         params = {
             "account": account,
-            "bpend": initdb.TAG_BANK_PENDING,
-            "brec": initdb.TAG_BANK_RECONCILED,
+            "bpend": tags[initdb.TAG_BANK_PENDING],
+            "brec": tags[initdb.TAG_BANK_RECONCILED],
         }
 
         cm = api.ColumnMap(summary=api.cgen.currency_usd())
         results.tables["account"] = api.sql_tab2(conn, select_acc, params, cm)
-        acnt = results.tables["account"][1][0]
 
         cm = api.ColumnMap(
             tid=api.cgen.__meta__(),
@@ -80,75 +210,139 @@ where accounts.id=%(account)s"""
             credit=api.cgen.currency_usd(),
             balance=api.cgen.currency_usd(hidden=True),
         )
-        data = api.sql_tab2(conn, select, params, cm)
+        results.tables["trans"] = api.sql_tab2(conn, select, params, cm)
+    return results
+
 
-        columns = api.tab2_columns_transform(
-            data[0], insert=[("debit", "credit", "balance")], column_map=cm
+# Diff the submitted pending & reconciled flags against the tags in one
+# statement; only tag rows which change are deleted or inserted.  The
+# reconciled changes are returned for the statement record.
+RECONCILE_UPDATE = """
+with SPLIT_KEYS, tagged as (
+    select tags.tag_id, splits.sid as split_id,
+        case when tags.pending then splitkeys.pending
+            else splitkeys.reconciled end as wanted
+    from splitkeys
+    join hacc.splits on splits.sid=splitkeys.sid::uuid
+        and splits.account_id=%(account)s
+    cross join (
+        values (%(bpend)s::uuid, true), (%(brec)s::uuid, false)
+        ) tags(tag_id, pending)
+), removed as (
+    delete from hacc.tagsplits
+    using tagged
+    where tagsplits.tag_id=tagged.tag_id and tagsplits.split_id=tagged.split_id
+        and not tagged.wanted
+    returning tagsplits.tag_id, tagsplits.split_id
+), added as (
+    insert into hacc.tagsplits (tag_id, split_id)
+    select tagged.tag_id, tagged.split_id
+    from tagged
+    where tagged.wanted and not exists (
+        select 1 from hacc.tagsplits existing
+        where existing.tag_id=tagged.tag_id and existing.split_id=tagged.split_id)
+    on conflict (tag_id, split_id) do nothing
+    returning tag_id, split_id
+), changes as (
+    select added.split_id, true as reconciled
+    from added
+    where added.tag_id=%(brec)s
+    union all
+    select removed.split_id, false as reconciled
+    from removed
+    where removed.tag_id=%(brec)s
+)
+select changes.split_id, changes.reconciled, splits.sum
+from changes
+join hacc.splits on splits.sid=changes.split_id
+"""
+
+
+def _apply_reconcile(conn, account_id, trans, statement_date, version):
+    params = {"account": account_id}
+
+    # serialize with the transaction writers and other reconciliations of
+    # the account
+    dailybalances.lock_accounts(conn, [account_id])
+    # the account version moves with every write of the account's splits or
+    # their reconciliation so a stale reconciliation page is refused
+    if version != None and version != account_version(conn, account_id):
+        raise api.UserError(
+            "data-conflict",
+            "This reconciliation was changed by someone else; reload and try again.",
         )
 
-        def transform_dc(oldrow, row):
-            nonlocal acnt
-            d, c, b = dcb_values(acnt.debit_account, row.debit)
-            row.balance = b
-            row.debit = d
-            row.credit = c
+    x = trans.as_cte(conn, "splitkeys")
+
+    tags = initdb.system_tags.tag_ids(conn)
+    params["bpend"] = tags[initdb.TAG_BANK_PENDING]
+    params["brec"] = tags[initdb.TAG_BANK_RECONCILED]
+    changes = api.sql_rows(conn, RECONCILE_UPDATE.replace("SPLIT_KEYS", x), params)
 
-        rows = api.tab2_rows_transform(data, columns, transform_dc)
-        results.tables["trans"] = columns, rows
-    return results.json_out()
+    if len(changes) > 0:
+        if statement_date == None:
+            statement_date = api.get_request_today()
+        _write_statement(conn, params, statement_date, changes)
 
 
 @app.put("/api/transactions/reconcile", name="put_api_transactions_reconcile")
-def put_api_transactions_reconcile():
+def put_api_transactions_reconcile(request):
+    statement_date = api.parse_date(request.query.get("statement_date", None))
+    version = api.parse_int(request.query.get("version", None))
     trans = api.table_from_tab2("trans", required=["sid", "pending", "reconciled"])
     account = api.table_from_tab2("account", required=["id"], options=["rec_note"])
 
-    delete_pending = """
-with SPLIT_KEYS
-delete from hacc.tagsplits where (tag_id, split_id) in 
-(select tags.id, sid::uuid
-from splitkeys
-join hacc.tags on tags.tag_name=%(tagspec)s
-where not splitkeys./*COLUMN*/)
-"""
-    insert_pending = """
-with SPLIT_KEYS
-insert into hacc.tagsplits (tag_id, split_id)
-select tags.id, sid::uuid
-from splitkeys
-join hacc.tags on tags.tag_name=%(tagspec)s
-where splitkeys./*COLUMN*/
-on conflict (tag_id, split_id) do nothing
-"""
-
     with app.dbconn() as conn:
         with api.writeblock(conn) as w:
             # w.upsert_rows('hacc.transactions', trans)
             w.upsert_rows("hacc.accounts", account)
 
-        x = trans.as_cte(conn, "splitkeys")
+        account_id = account.rows[0].id
+        _apply_reconcile(conn, account_id, trans, statement_date, version)
+        (name,) = version_names([account_id])
+        bumped = versions.bump(conn, ["ledger", name])
+        version = bumped[name]
+        conn.commit()
+    # the reports do not show the reconciliation
+    reportcache.invalidate([], bumped["ledger"])
 
-        api.sql_void(
-            conn,
-            delete_pending.replace("SPLIT_KEYS", x).replace("/*COLUMN*/", "pending"),
-            {"tagspec": initdb.TAG_BANK_PENDING},
-        )
-        api.sql_void(
-            conn,
-            insert_pending.replace("SPLIT_KEYS", x).replace("/*COLUMN*/", "pending"),
-            {"tagspec": initdb.TAG_BANK_PENDING},
-        )
-        api.sql_void(
-            conn,
-            delete_pending.replace("SPLIT_KEYS", x).replace("/*COLUMN*/", "reconciled"),
-            {"tagspec": initdb.TAG_BANK_RECONCILED},
-        )
-        api.sql_void(
-            conn,
-            insert_pending.replace("SPLIT_KEYS", x).replace("/*COLUMN*/", "reconciled"),
-            {"tagspec": initdb.TAG_BANK_RECONCILED},
-        )
+    results = api.Results()
+    results.keys["reconcile-version"] = version
+    return results
 
+
+@app.put(
+    "/api/transactions/reconcile/delta", name="put_api_transactions_reconcile_delta"
+)
+def put_api_transactions_reconcile_delta(request):
+    """
+    Apply only the changed splits of a reconciliation.  The trans table has
+    just the sid's whose flags changed; the optional version is the
+    reconcile-version key from the GET (or the prior PUT) and is rejected if
+    the account's splits or their reconciliation were written since.
+    """
+    account = request.query.get("account")
+    statement_date = api.parse_date(request.query.get("statement_date", None))
+    version = api.parse_int(request.query.get("version", None))
+    trans = api.table_from_tab2("trans", required=["sid", "pending", "reconciled"])
+
+    if account in ["", None]:
+        raise api.UserError("parameter-validation", "The account is required.")
+
+    results = api.Results()
+    with app.dbconn() as conn:
+        bumped = None
+        if len(trans.rows) > 0:
+            _apply_reconcile(conn, account, trans, statement_date, version)
+            (name,) = version_names([account])
+            bumped = versions.bump(conn, ["ledger", name])
+            version = bumped[name]
+        else:
+            version = account_version(conn, account)
+        results.keys["reconcile-version"] = version
         conn.commit()
+    if bumped != None:
+        # the reports do not show the reconciliation
+        reportcache.invalidate([], bumped["ledger"])
 
-    return api.Results().json_out()
+    return results
@@ -0,0 +1,193 @@
+import os
+import collections
+import datetime
+import functools
+import threading
+import yenot.backend.api as api
+from . import bankday
+from . import versions
+from . import streaming
+from . import perfstats
+
+app = api.get_global_app()
+
+# Budget for the serialized reports held by each server process; 0 disables
+# the cache.
+MAX_BYTES = int(os.environ.get("LHSERVER_REPORT_CACHE_BYTES", 64 * 1024 * 1024))
+
+
+class ReportCache:
+    """
+    LRU cache of serialized report payloads.  Each entry carries the span of
+    transaction dates (first, last) it summarizes (None is an open end), the
+    ledger version it was computed at and the ledger version it is known to
+    be current at.
+
+    The ledger version is shared by all server processes so an entry is only
+    served while the ledger is still at the version it is known current at.
+    A write in this process moves the entries outside its dates on to the
+    version of the write.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, current):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry == None:
+                return None, None
+            if entry[3] != current:
+                self._evict(key)
+                return None, None
+            self.entries.move_to_end(key)
+            return entry[1], entry[2]
+
+    def put(self, key, span, payload, version):
+        size = len(payload)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._evict(key)
+            self.entries[key] = (span, payload, version, version)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._evict(next(iter(self.entries)))
+
+    def _evict(self, key):
+        _, payload, _, _ = self.entries.pop(key)
+        self.size -= len(payload)
+
+    def invalidate(self, dates, version):
+        dates = [d for d in dates if d != None]
+        lo, hi = (min(dates), max(dates)) if len(dates) > 0 else (None, None)
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                (first, last), payload, computed, current = entry
+                if lo != None and (first == None or first <= hi):
+                    if last == None or lo <= last:
+                        self._evict(key)
+                        continue
+                # the write of version is the only one since the entry was
+                # known current and it does not touch the entry's dates
+                if current == version - 1:
+                    self.entries[key] = ((first, last), payload, computed, version)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+cache = ReportCache(MAX_BYTES)
+
+
+def invalidate(dates, version):
+    """
+    Drop the cached reports depending on any date in [min(dates), max(dates)]
+    after the write committing ledger version `version`.
+    """
+    cache.invalidate(dates, version)
+
+
+def clear():
+    """
+    Drop every cached report; used when account setup (names, types,
+    journals) changes since that shows in every report.
+    """
+    cache.clear()
+
+
+def cached(span):
+    """
+    Cache the serialized result of a report route keyed by the route and its
+    query parameters.  `span` maps the request to the (first, last) dates of
+    the transactions the report depends on so that a write only evicts the
+    reports it can change.
+
+    The decorated route returns its api.Results unserialized; the ledger
+    version it was computed at is added as the key ledger-version.  A request
+    passing that version back as if-changed-since gets an empty result with
+    the key unchanged when the report cannot have changed since.  Streamed
+    reports are not cached.
+    """
+
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(request):
+            if streaming.wants_stream(request):
+                return func(request)
+
+            since = api.parse_int(request.query.get("if-changed-since"))
+            params = sorted(
+                (k, v)
+                for k, v in request.query.items()
+                if v != "" and k != "if-changed-since"
+            )
+            key = (func.__name__, tuple(params))
+            with app.dbconn() as conn:
+                version = versions.ledger_version(conn)
+            payload, computed = cache.get(key, version)
+            if payload != None:
+                # the cached report has not changed since it was computed
+                if since != None and computed <= since:
+                    return unchanged(since)
+                return payload
+
+            if since != None and version == since:
+                return unchanged(since)
+            results = func(request)
+            results.keys["ledger-version"] = version
+            with perfstats.phase("serialize"):
+                payload = results.json_out()
+            cache.put(key, span(request), payload, version)
+            return payload
+
+        return wrapper
+
+    return decorate
+
+
+def unchanged(version):
+    results = api.Results()
+    results.keys["ledger-version"] = version
+    results.keys["unchanged"] = True
+    return results
+
+
+def span_through_date(request):
+    return None, api.parse_date(request.query.get("date"))
+
+
+def span_date1_date2(request):
+    return (
+        api.parse_date(request.query.get("date1")),
+        api.parse_date(request.query.get("date2")),
+    )
+
+
+def span_current_balance(request):
+    # the recently active accounts look 30 days past the date
+    date = api.parse_date(request.query.get("date"))
+    return None, date + datetime.timedelta(days=30) if date != None else None
+
+
+def span_multi_balance_sheet(request):
+    year = api.parse_int(request.query.get("year"))
+    month = api.parse_int(request.query.get("month_end"))
+    return None, bankday.month_end(year, month)
+
+
+def span_interval_p_and_l(request):
+    edate = api.parse_date(request.query.get("ending_date"))
+    intervals = api.parse_int(request.query.get("intervals"))
+    length = api.parse_int(request.query.get("length"))
+    ed1 = datetime.date(edate.year, edate.month, 1)
+    return (
+        bankday.n_months_earlier(ed1, intervals * length - 1),
+        bankday.month_end(ed1),
+    )
@@ -25,3 +25,26 @@ def HaccColumnMap(**kwargs):
 
 def hacc_columns(columns):
     return [(attr, enrich_meta(meta)) for attr, meta in columns]
+
+
+def debit_credit_balance(amount, debit, suffix="", by_sign=False):
+    """
+    Return the SQL select list of the columns debit, credit and balance (each
+    with `suffix`) for the debit positive SQL expression `amount` of an
+    account where the SQL boolean `debit` is true for debit accounts.
+
+    The amount shows in the debit column for debit accounts and negated in the
+    credit column otherwise; with `by_sign` it shows in the column matching
+    its sign (a zero on the account's side).  The balance is positive for the
+    normal side of the account.
+    """
+    # a NULL debit is a credit account
+    debit = f"coalesce({debit}, false)"
+    if by_sign:
+        d = f"case when {amount}>0 or ({amount}=0 and {debit}) then {amount} end"
+        c = f"case when {amount}<0 or ({amount}=0 and not {debit}) then -({amount}) end"
+    else:
+        d = f"case when {debit} then {amount} end"
+        c = f"case when not {debit} then -({amount}) end"
+    b = f"case when {debit} then {amount} else -({amount}) end"
+    return f"{d} as debit{suffix}, {c} as credit{suffix}, {b} as balance{suffix}"
@@ -0,0 +1,55 @@
+import uuid
+import bottle
+import yenot.backend.api as api
+
+app = api.get_global_app()
+
+# A client accepting CONTENT_TYPE gets the large detail reports as newline
+# delimited json read through a named (server side) cursor BATCH_ROWS at a
+# time so the worker memory does not grow with the result.  Each line is a
+# yenot results payload:  the first has the keys and the table with its
+# columns and no rows, each further line the table with the next batch of
+# rows.
+
+CONTENT_TYPE = "application/x-ndjson"
+BATCH_ROWS = 2000
+
+
+def wants_stream(request):
+    return CONTENT_TYPE in request.headers.get("Accept", "")
+
+
+def stream_tab2(results, name, select, params, column_map):
+    """
+    Return a generator streaming the rows of `select` after a header line
+    with the keys of `results` and the columns of `select` as sql_tab2 maps
+    them.
+    """
+
+    def generate():
+        with app.dbconn() as conn:
+            cursor = conn.cursor(name=f"stream_{uuid.uuid1().hex}")
+            cursor.itersize = BATCH_ROWS
+            cursor.execute(select, params)
+            # fetching no rows of the declared cursor gives the column
+            # metadata without planning the query again
+            columns, _ = api.sql_tab2(
+                conn, f'fetch forward 0 from "{cursor.name}"', None, column_map
+            )
+            results.tables[name, True] = columns, []
+            header = results.json_out() + "\n"
+            # the headers are sent after the first line is made
+            bottle.response.content_type = CONTENT_TYPE
+            yield header
+
+            while True:
+                rows = cursor.fetchmany(BATCH_ROWS)
+                if len(rows) == 0:
+                    break
+                batch = api.Results()
+                batch.tables[name, True] = columns, rows
+                yield batch.json_out() + "\n"
+            cursor.close()
+            conn.rollback()
+
+    return generate()
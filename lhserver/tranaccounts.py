@@ -0,0 +1,85 @@
+import yenot.backend.api as api
+from . import reportcache
+from . import versions
+
+app = api.get_global_app()
+
+# The account names of each transaction ordered by the size of the amount
+# against each account are kept in hacc.transaction_accounts for the
+# transaction list and detail reports.  They are rewritten for the affected
+# transactions when splits change or when an account is renamed (or an
+# account type resorted).
+
+TRANSACTION_ACCOUNTS = """
+with raw as (
+    select splits.stid, accounts.acc_name, accounttypes.sort,
+        abs(sum(splits.sum)) as amount
+    from hacc.splits
+    join hacc.accounts on splits.account_id=accounts.id
+    join hacc.accounttypes on accounttypes.id=accounts.type_id
+    where /*WHERE*/
+    group by splits.stid, accounts.acc_name, accounttypes.sort
+)
+insert into hacc.transaction_accounts (tid, accounts)
+select raw.stid,
+    array_agg(raw.acc_name order by raw.amount desc, raw.sort, raw.acc_name)
+from raw
+group by raw.stid
+"""
+
+
+def _refresh(conn, tidset, params):
+    api.sql_void(
+        conn,
+        f"delete from hacc.transaction_accounts where tid in ({tidset})",
+        params,
+    )
+    api.sql_void(
+        conn,
+        TRANSACTION_ACCOUNTS.replace("/*WHERE*/", f"splits.stid in ({tidset})"),
+        params,
+    )
+
+
+def refresh_transactions(conn, tids):
+    _refresh(conn, "select unnest(%(tids)s::uuid[])", {"tids": list(tids)})
+
+
+def refresh_accounts(conn, account_ids):
+    tidset = "select splits.stid from hacc.splits where splits.account_id=any(%(accounts)s::uuid[])"
+    _refresh(conn, tidset, {"accounts": list(account_ids)})
+
+
+def refresh_accounttype(conn, atype_id):
+    tidset = """
+select splits.stid
+from hacc.splits
+join hacc.accounts on accounts.id=splits.account_id
+where accounts.type_id=%(atype)s"""
+    _refresh(conn, tidset, {"atype": atype_id})
+
+
+def remove_transactions(conn, tids):
+    api.sql_void(
+        conn,
+        "delete from hacc.transaction_accounts where tid=any(%(tids)s::uuid[])",
+        {"tids": list(tids)},
+    )
+
+
+def rebuild(conn):
+    api.sql_void(conn, "delete from hacc.transaction_accounts")
+    api.sql_void(conn, TRANSACTION_ACCOUNTS.replace("/*WHERE*/", "true"))
+
+
+@app.put(
+    "/api/transactions/account-summaries/rebuild",
+    name="put_api_transactions_account_summaries_rebuild",
+)
+def put_api_transactions_account_summaries_rebuild():
+    with app.dbconn() as conn:
+        rebuild(conn)
+        versions.bump(conn, ["ledger"])
+        conn.commit()
+    reportcache.clear()
+    return api.Results()
@@ -1,7 +1,18 @@
+import io
 import uuid
 import datetime
 import json
 import yenot.backend.api as api
+from . import dailybalances
+from . import closing
+from . import reportcache
+from . import tranaccounts
+from . import reconcile
+from . import gledger
+from . import versions
+from . import changelog
+from . import streaming
+from . import perfstats
 
 app = api.get_global_app()
 
@@ -22,7 +33,7 @@ order by date_part('year', trandate)::text
     results = api.Results(default_title=True)
     with app.dbconn() as conn:
         results.tables["years", True] = api.sql_tab2(conn, select, None, None)
-    return results.json_out()
+    return results
 
 
 def get_api_transactions_tran_detail_prompts():
@@ -42,6 +53,7 @@ def get_api_transactions_tran_detail_prompts():
     report_title="Transaction Detail",
     report_prompts=get_api_transactions_tran_detail_prompts,
 )
+@reportcache.cached(span=reportcache.span_date1_date2)
 def get_api_transactions_tran_detail(request):
     date1 = api.parse_date(request.query.get("date1"))
     date2 = api.parse_date(request.query.get("date2"))
@@ -71,19 +83,7 @@ from hacc.transactions
 join hacc.splits on splits.stid=transactions.tid
 join hacc.accounts on splits.account_id=accounts.id
 join hacc.accounttypes on accounttypes.id=accounts.type_id
-join lateral (
-    with raw as (
-        select accounts.acc_name
-        from hacc.splits
-        join hacc.accounts on splits.account_id=accounts.id
-        join hacc.accounttypes on accounttypes.id=accounts.type_id
-        where splits.stid=transactions.tid
-        group by accounts.acc_name, accounttypes.sort
-        order by abs(sum(splits.sum)) desc, accounttypes.sort, accounts.acc_name
-    )
-    select array_agg(acc_name) as accounts
-    from raw
-    ) details on true
+left outer join hacc.transaction_accounts details on details.tid=transactions.tid
 where /*WHERE*/
 order by transactions.trandate, transactions.tranref, 
     transactions.payee, transactions.memo, accounttypes.sort, accounts.acc_name
@@ -123,7 +123,9 @@ order by transactions.trandate, transactions.tranref,
             credit=api.cgen.currency_usd(widget_kwargs={"blankzero": True}),
             accounts=api.cgen.stringlist(),
         )
-        results.tables["trans", True] = api.sql_tab2(conn, select, params, cm)
+        stream = streaming.wants_stream(request)
+        if not stream:
+            results.tables["trans", True] = api.sql_tab2(conn, select, params, cm)
 
         if account not in ["", None]:
             accname = api.sql_1row(
@@ -143,7 +145,9 @@ order by transactions.trandate, transactions.tranref,
             results.key_labels += f'Containing "{fragment}"'
 
     results.keys["report-formats"] = ["gl_summarize_total"]
-    return results.json_out()
+    if stream:
+        return streaming.stream_tab2(results, "trans", select, params, cm)
+    return results
 
 
 @app.put("/api/transactions/poll-changes", name="put_api_transactions_poll_changes")
@@ -224,12 +228,13 @@ where /*WHERE*/"""
             columns, insert=[("tid", "tran_status_color", "tran_status")], column_map=cm
         )
 
-        if newrow:
-            rows = api.tab2_rows_default(newcols, [None], tran_default)
-        elif copy:
-            rows = api.tab2_rows_transform((columns, rows), newcols, tran_clear)
-        else:
-            rows = api.tab2_rows_transform((columns, rows), newcols, tran_status)
+        with perfstats.phase("transform"):
+            if newrow:
+                rows = api.tab2_rows_default(newcols, [None], tran_default)
+            elif copy:
+                rows = api.tab2_rows_transform((columns, rows), newcols, tran_clear)
+            else:
+                rows = api.tab2_rows_transform((columns, rows), newcols, tran_status)
 
         results.tables["trans"] = newcols, rows
 
@@ -257,7 +262,10 @@ where /*WHERE*/"""
                 # unambiguously correct.
                 row.tags = []
 
-            rows = api.tab2_rows_transform((columns, rows), columns, split_reconnect)
+            with perfstats.phase("transform"):
+                rows = api.tab2_rows_transform(
+                    (columns, rows), columns, split_reconnect
+                )
         results.tables["splits"] = columns, rows
 
         results.tables["tags"] = api.sql_tab2(conn, "select * from hacc.tags")
@@ -268,19 +276,28 @@ where /*WHERE*/"""
 def get_api_transaction_new():
     results = _get_api_transaction(newrow=True)
     results.keys["new_row"] = True
-    return results.json_out()
+    return results
 
 
 @app.get("/api/transaction/<t_id>", name="get_api_transaction")
 def get_api_transaction(t_id):
     results = _get_api_transaction(tid=t_id)
-    return results.json_out()
+    return results
 
 
 @app.get("/api/transaction/<t_id>/copy", name="get_api_transaction_copy")
 def get_api_transaction_copy(t_id):
     results = _get_api_transaction(tid=t_id, copy=True)
-    return results.json_out()
+    return results
+
+
+# hacc.splits.trandate copies the date of the transaction for the account
+# register index.
+SPLIT_TRANDATES = """
+update hacc.splits set trandate=transactions.trandate
+from hacc.transactions
+where transactions.tid=splits.stid and splits.stid=%(tid)s
+    and splits.trandate is distinct from transactions.trandate"""
 
 
 @app.put("/api/transaction/<t_id>", name="put_api_transaction")
@@ -288,7 +305,7 @@ def put_api_transaction(t_id):
     trans = api.table_from_tab2("trans", amendments=["tid"], allow_extra=True)
     splits = api.table_from_tab2(
         "splits",
-        amendments=["stid", "sid"],
+        amendments=["stid", "sid", "trandate"],
         required=["account_id", "sum"],
         options=["tags"],
         matrix=["tags"],
@@ -298,31 +315,295 @@ def put_api_transaction(t_id):
         row.tid = t_id
     for row in splits.rows:
         row.stid = t_id
+        row.trandate = trans.rows[0].trandate
+
+    select_date = "select trandate from hacc.transactions where tid=%(tid)s"
 
     with app.dbconn() as conn:
+        accounts = dailybalances.lock_transaction_accounts(
+            conn, [t_id], [row.account_id for row in splits.rows]
+        )
+        olddate = api.sql_1row(conn, select_date, {"tid": t_id})
+        before = changelog.snapshot(conn, [t_id])
+        oldreconciled = reconcile.reconciled_sums(conn, [t_id])
+        dailybalances.apply_transactions(conn, [t_id], -1)
         with api.writeblock(conn) as w:
             w.upsert_rows("hacc.transactions", trans)
             w.upsert_rows("hacc.splits", splits, matrix={"tags": "hacc.tagsplits"})
+        api.sql_void(conn, SPLIT_TRANDATES, {"tid": t_id})
+        dailybalances.apply_transactions(conn, [t_id], 1)
+        tranaccounts.refresh_transactions(conn, [t_id])
+        gledger.refresh_unbalanced(conn, [t_id])
+        reconcile.invalidate_statements(
+            conn, oldreconciled, reconcile.reconciled_sums(conn, [t_id])
+        )
+        newdate = api.sql_1row(conn, select_date, {"tid": t_id})
+        closing.check_open_dates(conn, [olddate, newdate])
         payload = json.dumps({"date": str(trans.rows[0].trandate)})
         api.notify_listener(conn, "transactions", payload)
+        names = ["ledger"] + reconcile.version_names(accounts)
+        version = versions.bump(conn, names)["ledger"]
+        changelog.record(conn, version, before, changelog.snapshot(conn, [t_id]))
         conn.commit()
-    return api.Results().json_out()
+    reportcache.invalidate([olddate, newdate], version)
+    return api.Results()
 
 
 @app.delete("/api/transaction/<t_id>", name="delete_api_transaction")
 def delete_api_transaction(t_id):
     with app.dbconn() as conn:
+        accounts = dailybalances.lock_transaction_accounts(conn, [t_id])
         trandate = api.sql_1row(
             conn,
             "select trandate from hacc.transactions where tid=%(tid)s",
             {"tid": t_id},
         )
+        closing.check_open_dates(conn, [trandate])
+        before = changelog.snapshot(conn, [t_id])
         payload = json.dumps({"date": str(trandate)})
         api.notify_listener(conn, "transactions", payload)
 
+        dailybalances.apply_transactions(conn, [t_id], -1)
+        tranaccounts.remove_transactions(conn, [t_id])
+        reconcile.invalidate_statements(
+            conn, reconcile.reconciled_sums(conn, [t_id]), {}
+        )
         api.sql_void(conn, "delete from hacc.splits where stid=%(tid)s", {"tid": t_id})
+        gledger.refresh_unbalanced(conn, [t_id])
         api.sql_void(
             conn, "delete from hacc.transactions where tid=%(tid)s", {"tid": t_id}
         )
+        names = ["ledger"] + reconcile.version_names(accounts)
+        version = versions.bump(conn, names)["ledger"]
+        changelog.record(conn, version, before, {})
         conn.commit()
-    return api.Results().json_out()
+    reportcache.invalidate([trandate], version)
+    return api.Results()
+
+
+IMPORT_STAGING = """
+create temporary table import_trans (
+    tid uuid not null,
+    trandate date not null,
+    tranref varchar(15),
+    payee text,
+    memo text,
+    receipt text
+) on commit drop;
+
+create temporary table import_splits (
+    sid uuid,
+    stid uuid not null,
+    account_id uuid not null,
+    sum numeric(10,2) not null
+) on commit drop;
+
+create temporary table import_rows (
+    tid uuid not null,
+    trandate date not null,
+    tranref varchar(15),
+    payee text,
+    memo text,
+    account_id uuid not null,
+    sum numeric(10,2) not null
+) on commit drop;
+"""
+
+IMPORT_CSV_COLUMNS = ["tid", "trandate", "tranref", "payee", "memo", "account_id", "sum"]
+
+
+def _copy_text(value):
+    if value == None:
+        return "\\N"
+    value = str(value)
+    for char, escaped in [("\\", "\\\\"), ("\t", "\\t"), ("\n", "\\n"), ("\r", "\\r")]:
+        value = value.replace(char, escaped)
+    return value
+
+
+def _copy_rows(conn, table, columns, rows):
+    buffer = io.StringIO()
+    for row in rows:
+        values = [_copy_text(getattr(row, col, None)) for col in columns]
+        buffer.write("\t".join(values) + "\n")
+    buffer.seek(0)
+    cursor = conn.cursor()
+    cursor.copy_expert(f"copy {table} ({', '.join(columns)}) from stdin", buffer)
+
+
+@app.put("/api/transactions/import", name="put_api_transactions_import")
+def put_api_transactions_import(request):
+    """
+    Import many new transactions in one database transaction.  Either send
+    tab2 tables trans & splits (as for a single transaction with stid
+    linking the splits) or a csv file upload named csv with a header and one
+    row per split in the columns of IMPORT_CSV_COLUMNS.
+    """
+    upload = request.files.get("csv")
+
+    with app.dbconn() as conn:
+        api.sql_void(conn, IMPORT_STAGING)
+
+        if upload != None:
+            cursor = conn.cursor()
+            cursor.copy_expert(
+                f"copy import_rows ({', '.join(IMPORT_CSV_COLUMNS)}) from stdin with (format csv, header true)",
+                upload.file,
+            )
+            conflicts = api.sql_1row(
+                conn,
+                """
+select count(*)
+from (
+    select tid
+    from import_rows
+    group by tid
+    having count(distinct (trandate, tranref, payee, memo))>1
+    ) conflicts""",
+            )
+            if conflicts > 0:
+                raise api.UserError(
+                    "invalid-input",
+                    f"{conflicts} transactions have rows with differing dates, references, payees or memos.",
+                )
+            api.sql_void(
+                conn,
+                """
+insert into import_trans (tid, trandate, tranref, payee, memo)
+select distinct on (tid) tid, trandate, tranref, payee, memo
+from import_rows
+order by tid""",
+            )
+            api.sql_void(
+                conn,
+                """
+insert into import_splits (stid, account_id, sum)
+select tid, account_id, sum
+from import_rows""",
+            )
+        else:
+            trans = api.table_from_tab2(
+                "trans",
+                required=["tid", "trandate"],
+                options=["tranref", "payee", "memo", "receipt"],
+            )
+            splits = api.table_from_tab2(
+                "splits", required=["stid", "account_id", "sum"], options=["sid"]
+            )
+            _copy_rows(
+                conn,
+                "import_trans",
+                ["tid", "trandate", "tranref", "payee", "memo", "receipt"],
+                trans.rows,
+            )
+            _copy_rows(
+                conn, "import_splits", ["sid", "stid", "account_id", "sum"], splits.rows
+            )
+
+        count, date1, date2 = api.sql_1row(
+            conn, "select count(*), min(trandate), max(trandate) from import_trans"
+        )
+        if count == 0:
+            raise api.UserError("invalid-input", "There are no transactions to import.")
+
+        duplicates = api.sql_1row(
+            conn,
+            """
+select count(*)
+from (
+    select tid from import_trans group by tid having count(*)>1
+    union all
+    select sid from import_splits where sid is not null group by sid having count(*)>1
+    ) duplicates""",
+        )
+        if duplicates > 0:
+            raise api.UserError(
+                "invalid-input", f"{duplicates} transaction or split ids are repeated."
+            )
+
+        existing = api.sql_1row(
+            conn,
+            """
+select count(*)
+from import_trans
+join hacc.transactions on transactions.tid=import_trans.tid""",
+        )
+        if existing > 0:
+            raise api.UserError(
+                "invalid-input", f"{existing} of the transactions already exist."
+            )
+
+        orphans = api.sql_1row(
+            conn,
+            """
+select count(*)
+from import_splits
+where not exists (select 1 from import_trans where import_trans.tid=import_splits.stid)""",
+        )
+        if orphans > 0:
+            raise api.UserError(
+                "invalid-input", f"{orphans} splits do not belong to an imported transaction."
+            )
+
+        unbalanced = api.sql_1row(
+            conn,
+            """
+select count(*)
+from import_trans
+left outer join (
+    select import_splits.stid, sum(import_splits.sum) as total
+    from import_splits
+    group by import_splits.stid
+    ) totals on totals.stid=import_trans.tid
+where coalesce(totals.total, 0)<>0 or totals.stid is null""",
+        )
+        if unbalanced > 0:
+            raise api.UserError(
+                "invalid-input",
+                f"{unbalanced} transactions have no splits or do not balance.",
+            )
+
+        accounts = [
+            row.account_id
+            for row in api.sql_rows(
+                conn, "select distinct account_id::text from import_splits"
+            )
+        ]
+        dailybalances.lock_accounts(conn, accounts)
+        closing.check_open_dates(conn, [date1])
+
+        api.sql_void(
+            conn,
+            """
+insert into hacc.transactions (tid, trandate, tranref, payee, memo, receipt)
+select tid, trandate, tranref, payee, memo, receipt
+from import_trans""",
+        )
+        api.sql_void(
+            conn,
+            """
+insert into hacc.splits (sid, stid, account_id, sum, trandate)
+select coalesce(import_splits.sid, uuid_generate_v1mc()), import_splits.stid,
+    import_splits.account_id, import_splits.sum, import_trans.trandate
+from import_splits
+join import_trans on import_trans.tid=import_splits.stid""",
+        )
+
+        tids = [
+            str(row.tid) for row in api.sql_rows(conn, "select tid from import_trans")
+        ]
+        dailybalances.apply_transactions(conn, tids, 1)
+        tranaccounts.refresh_transactions(conn, tids)
+        gledger.refresh_unbalanced(conn, tids)
+
+        payload = json.dumps({"date": str(date1), "date2": str(date2)})
+        api.notify_listener(conn, "transactions", payload)
+        names = ["ledger"] + reconcile.version_names(accounts)
+        version = versions.bump(conn, names)["ledger"]
+        changelog.record_inserts(conn, version, tids)
+        conn.commit()
+    reportcache.invalidate([date1, date2], version)
+
+    results = api.Results()
+    results.keys["imported"] = count
+    return results
@@ -0,0 +1,70 @@
+import bottle
+import yenot.backend.api as api
+from . import columnar
+
+# Content versions of the rarely changing setup tables are counters in
+# hacc.content_versions bumped by their writers in the same database
+# transaction.  The list routes derive an ETag from them and answer a
+# matching If-None-Match with 304 before running their query.
+#
+# The ledger counter is bumped by every write to transactions and account
+# setup and versions the reports as a whole.
+
+
+def bump(conn, names):
+    rows = api.sql_rows(
+        conn,
+        """
+insert into hacc.content_versions (name, version)
+select unnest(%(names)s::text[]), 1
+on conflict (name) do update set version=content_versions.version+1
+returning name, version""",
+        {"names": sorted(names)},
+    )
+    return {row.name: row.version for row in rows}
+
+
+def current(conn, names):
+    rows = api.sql_rows(
+        conn,
+        "select name, version from hacc.content_versions where name=any(%(names)s::text[])",
+        {"names": list(names)},
+    )
+    found = {row.name: row.version for row in rows}
+    return {name: found.get(name, 0) for name in names}
+
+
+def ledger_version(conn):
+    return current(conn, ["ledger"])["ledger"]
+
+
+def etag_matches(header, etag):
+    """
+    Weak comparison of `etag` with the If-None-Match header `header`, a comma
+    separated list of entity tags or *.
+    """
+    if header == None:
+        return False
+    tags = [tag.strip() for tag in header.split(",")]
+    tags = [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+    return "*" in tags or etag in tags
+
+
+def not_modified(conn, request, names):
+    """
+    Return a 304 response if the client's If-None-Match matches the current
+    versions of `names`; otherwise set the ETag on the response and return
+    None.  The columnar and tab2 representations have distinct ETags.
+    """
+    versions = current(conn, sorted(names))
+    tag = "-".join(f"{n}.{v}" for n, v in versions.items())
+    if columnar.wants_columnar(request):
+        tag += "-columnar"
+    etag = f'"{tag}"'
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return bottle.HTTPResponse(
+            status=304, headers={"ETag": etag, "Vary": "Accept"}
+        )
+    bottle.response.set_header("ETag", etag)
+    bottle.response.add_header("Vary", "Accept")
+    return None
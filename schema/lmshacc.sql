@@ -1,4 +1,5 @@
 create extension if not exists "uuid-ossp";
+create extension if not exists pg_trgm;
 
 create schema hacc;
 
@@ -57,13 +58,82 @@ create table hacc.splits (
   sid uuid primary key default uuid_generate_v1mc(),
   stid uuid not null references hacc.transactions(tid),
   account_id uuid not null references hacc.accounts(id),
-  sum numeric(10,2)
+  sum numeric(10,2),
+  -- copy of transactions.trandate kept by the transaction writers
+  trandate date not null
 );
 
 create index stid_idx on hacc.splits(stid);
+create index splits_register_idx on hacc.splits(account_id, trandate, stid, sid);
 
 create table hacc.tagsplits (
   tag_id uuid not null references hacc.tags(id),
   split_id uuid not null references hacc.splits(sid),
   primary key(tag_id, split_id)
 );
+
+create table hacc.account_daily_balances (
+  account_id uuid not null references hacc.accounts(id),
+  bal_date date not null,
+  delta numeric(14,2) not null default 0,
+  cumulative numeric(14,2) not null default 0,
+  primary key(account_id, bal_date)
+);
+
+create table hacc.period_closes (
+  close_date date primary key,
+  closed_at timestamp not null default current_timestamp
+);
+
+create index adb_date_idx on hacc.account_daily_balances(bal_date);
+
+create index transactions_trandate_idx on hacc.transactions(trandate desc, tid);
+
+create table hacc.transaction_accounts (
+  tid uuid primary key references hacc.transactions(tid),
+  accounts text[]
+);
+
+create index transactions_payee_trgm_idx on hacc.transactions using gin (payee gin_trgm_ops);
+create index transactions_memo_trgm_idx on hacc.transactions using gin (memo gin_trgm_ops);
+
+create table hacc.reconcile_statements (
+  id serial primary key,
+  account_id uuid not null references hacc.accounts(id),
+  statement_date date not null,
+  reconciled_balance numeric(14,2) not null,
+  stale boolean not null default false,
+  created_at timestamp not null default current_timestamp
+);
+
+create index reconcile_statements_account_idx on hacc.reconcile_statements(account_id, id);
+
+create table hacc.reconcile_statement_splits (
+  statement_id integer not null references hacc.reconcile_statements(id),
+  split_id uuid not null,
+  reconciled boolean not null,
+  primary key(statement_id, split_id)
+);
+
+create table hacc.unbalanced_trans (
+  tid uuid not null references hacc.transactions(tid),
+  journal_id uuid not null references hacc.journals(id),
+  unbalance numeric(14,2) not null,
+  primary key(tid, journal_id)
+);
+
+create table hacc.content_versions (
+  name varchar(60) primary key,
+  version bigint not null
+);
+
+create table hacc.transaction_changes (
+  id bigserial primary key,
+  version bigint not null,
+  tid uuid not null,
+  sid uuid,
+  trandate date not null,
+  change varchar(6) not null
+);
+
+create index transaction_changes_version_idx on hacc.transaction_changes(version);
@@ -0,0 +1,384 @@
+import os
+import sys
+import json
+import gzip
+import time
+import argparse
+import datetime
+import statistics
+import psycopg2
+import yenot.client as yclient
+import yenot.tests
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+TEST_DATABASE = "yenot_bench"
+
+
+def test_url(dbname):
+    if "YENOT_DB_URL" in os.environ:
+        return os.environ["YENOT_DB_URL"]
+    # Fall back to local unix socket.  This is the url for unix domain socket.
+    return f"postgresql:///{dbname}"
+
+
+def init_database(dburl):
+    r = os.system(
+        "{} ../yenot/scripts/init-database.py {} --full-recreate \
+            --ddl-script=schema/lmshacc.sql \
+            --module=lhserver".format(
+            sys.executable, dburl
+        )
+    )
+    if r != 0:
+        print("error exit")
+        sys.exit(r)
+
+
+ACCOUNT_TYPES = [
+    # name, balance_sheet, debit, sort
+    ("Asset", True, True, 10),
+    ("Liability", True, False, 20),
+    ("Capital", True, False, 30),
+    ("Revenue", False, False, 40),
+    ("Expense", False, True, 50),
+]
+
+GENERATE_TRANSACTIONS = """
+insert into hacc.transactions (trandate, tranref, payee, memo)
+select
+    %(start)s::date + (g::bigint * %(days)s / %(count)s)::integer,
+    (g %% 10000)::text,
+    'Payee ' || (g %% %(payees)s),
+    'Memo ' || md5(g::text)
+from generate_series(0, %(count)s-1) g
+"""
+
+# Each transaction moves an amount between a bank (asset) account and either
+# a revenue account (every tenth) or an expense account (the rest).
+GENERATE_SPLITS = """
+with typed as (
+    select accounttypes.atype_name, array_agg(accounts.id order by accounts.acc_name) as ids
+    from hacc.accounts
+    join hacc.accounttypes on accounttypes.id=accounts.type_id
+    group by accounttypes.atype_name
+), numbered as (
+    select transactions.tid, transactions.trandate, row_number() over (order by transactions.trandate, transactions.tid) as n
+    from hacc.transactions
+), amounts as (
+    select numbered.tid, numbered.trandate, numbered.n,
+        ((numbered.n * 7919) %% 50000) / 100.0 + 1 as amount,
+        numbered.n %% 10 = 0 as revenue
+    from numbered
+)
+insert into hacc.splits (stid, account_id, sum, trandate)
+select amounts.tid,
+    bank.ids[1 + amounts.n %% array_length(bank.ids, 1)],
+    case when amounts.revenue then amounts.amount else -amounts.amount end,
+    amounts.trandate
+from amounts, typed bank
+where bank.atype_name='Asset'
+union all
+select amounts.tid,
+    other.ids[1 + (amounts.n / 7) %% array_length(other.ids, 1)],
+    case when amounts.revenue then -amounts.amount else amounts.amount end,
+    amounts.trandate
+from amounts, typed other
+where other.atype_name=case when amounts.revenue then 'Revenue' else 'Expense' end
+"""
+
+GENERATE_TAGS = """
+insert into hacc.tagsplits (tag_id, split_id)
+select tags.id, splits.sid
+from hacc.splits
+join hacc.transactions on transactions.tid=splits.stid
+join hacc.accounts on accounts.id=splits.account_id
+join hacc.accounttypes on accounttypes.id=accounts.type_id
+join hacc.tags on tags.tag_name=case
+    when transactions.trandate<%(end)s::date - 45 then 'Bank Reconciled'
+    else 'Bank Pending' end
+where accounttypes.atype_name='Asset'
+    and (transactions.trandate<%(end)s::date - 45 or splits.sid::text<'8')
+"""
+
+
+def generate_ledger(dburl, scale):
+    conn = psycopg2.connect(dburl)
+    cursor = conn.cursor()
+
+    cursor.execute(
+        "insert into hacc.journals (jrn_name) select 'Journal ' || g from generate_series(1, %(j)s) g",
+        {"j": scale["journals"]},
+    )
+    for name, balance_sheet, debit, sort in ACCOUNT_TYPES:
+        cursor.execute(
+            """
+insert into hacc.accounttypes (atype_name, balance_sheet, debit, sort)
+values (%(n)s, %(b)s, %(d)s, %(s)s)""",
+            {"n": name, "b": balance_sheet, "d": debit, "s": sort},
+        )
+
+    # one retained earnings account per journal collects the P&L accounts
+    cursor.execute(
+        """
+insert into hacc.accounts (type_id, journal_id, acc_name, description)
+select accounttypes.id, journals.id, 'RetEarn ' || right(journals.jrn_name, 3), 'Retained Earnings'
+from hacc.accounttypes, hacc.journals
+where accounttypes.atype_name='Capital'"""
+    )
+    cursor.execute(
+        """
+insert into hacc.accounts (type_id, journal_id, acc_name, description, retearn_id)
+select accounttypes.id, journals.id,
+    left(accounttypes.atype_name, 3) || ' ' || g || ' ' || right(journals.jrn_name, 3),
+    accounttypes.atype_name || ' account ' || g,
+    case when not accounttypes.balance_sheet then retearn.id end
+from hacc.accounttypes
+cross join hacc.journals
+join hacc.accounts retearn on retearn.journal_id=journals.id and retearn.description='Retained Earnings'
+cross join generate_series(1, %(a)s) g""",
+        {"a": scale["accounts"]},
+    )
+
+    end = datetime.date.today()
+    start = end - datetime.timedelta(days=365 * scale["years"])
+    cursor.execute(
+        GENERATE_TRANSACTIONS,
+        {
+            "start": start,
+            "days": (end - start).days,
+            "count": scale["transactions"],
+            "payees": scale["payees"],
+        },
+    )
+    cursor.execute(GENERATE_SPLITS, {})
+    cursor.execute(GENERATE_TAGS, {"end": end})
+    conn.commit()
+
+    conn.autocommit = True
+    cursor.execute("vacuum analyze")
+    conn.close()
+    return start, end
+
+
+def report_routes(conn, start, end):
+    cursor = conn.cursor()
+    cursor.execute(
+        """
+select accounts.id
+from hacc.accounts
+join hacc.accounttypes on accounttypes.id=accounts.type_id
+where accounttypes.atype_name='Asset'
+order by accounts.acc_name
+limit 1"""
+    )
+    bank = str(cursor.fetchone()[0])
+
+    year_begin = datetime.date(end.year, 1, 1)
+    month_end = year_begin - datetime.timedelta(days=1)
+    return [
+        ("api/gledger/balance-sheet", {"date": end}),
+        ("api/gledger/balance-sheet-summary", {"date": end}),
+        ("api/gledger/current-balance-accounts", {"date": end}),
+        (
+            "api/gledger/multi-balance-sheet",
+            {"year": month_end.year, "month_end": 12, "count": 4},
+        ),
+        ("api/gledger/profit-and-loss", {"date1": start, "date2": end}),
+        (
+            "api/gledger/interval-p-and-l",
+            {"ending_date": month_end, "intervals": 12, "length": 1},
+        ),
+        ("api/gledger/detailed-pl", {"date1": year_begin, "date2": end}),
+        ("api/transactions/tran-detail", {"date1": year_begin, "date2": end}),
+        (
+            "api/transactions/tran-detail",
+            {"date1": start, "date2": end, "fragment": "Payee 1"},
+        ),
+        ("api/transactions/list", {}),
+        (
+            "api/transactions/account-summary",
+            {"date1": start, "date2": end, "account": bank},
+        ),
+        ("api/transactions/reconcile", {"account": bank}),
+        ("api/gledger/unbalanced-trans", {}),
+        ("api/accounts/completions", {"prefix": "Exp"}),
+    ]
+
+
+def time_routes(client, routes, repeat):
+    results = []
+    for route, params in routes:
+        runs = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            client.get(route, **params)
+            runs.append(time.perf_counter() - t0)
+        results.append(
+            {
+                "route": route,
+                "params": {k: str(v) for k, v in params.items()},
+                "runs": runs,
+                "min": min(runs),
+                "median": statistics.median(runs),
+                "max": max(runs),
+            }
+        )
+    return results
+
+
+def compression_routes(start, end):
+    year_begin = datetime.date(end.year, 1, 1)
+    return [
+        ("api/transactions/tran-detail", {"date1": start, "date2": end}),
+        ("api/gledger/detailed-pl", {"date1": year_begin, "date2": end}),
+        ("api/transactions/list", {"limit": 5000}),
+    ]
+
+
+def codecs():
+    yield "gzip", 1, lambda data: gzip.compress(data, 1)
+    yield "gzip", 6, lambda data: gzip.compress(data, 6)
+    yield "gzip", 9, lambda data: gzip.compress(data, 9)
+    if zstandard != None:
+        for level in [1, 3, 10]:
+            yield "zstd", level, zstandard.ZstdCompressor(level=level).compress
+
+
+def time_compression(session, url, routes, repeat):
+    """
+    Fetch each route uncompressed and as served with each encoding, then time
+    compressing the raw payload at several levels to compare the CPU cost with
+    the bytes saved.
+    """
+    results = []
+    for route, params in routes:
+        served = {}
+        raw = None
+        for encoding in ["identity", "gzip", "zstd"]:
+            t0 = time.perf_counter()
+            response = session.get(
+                f"{url}/{route}",
+                params=params,
+                headers={"Accept-Encoding": encoding},
+                stream=True,
+            )
+            body = response.raw.read(decode_content=False)
+            elapsed = time.perf_counter() - t0
+            served[encoding] = {
+                "content-encoding": response.headers.get("Content-Encoding"),
+                "bytes": len(body),
+                "seconds": elapsed,
+            }
+            if encoding == "identity":
+                raw = body
+
+        local = []
+        for codec, level, func in codecs():
+            runs = []
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                size = len(func(raw))
+                runs.append(time.perf_counter() - t0)
+            local.append(
+                {
+                    "codec": codec,
+                    "level": level,
+                    "bytes": size,
+                    "ratio": size / len(raw) if len(raw) > 0 else None,
+                    "cpu_seconds": statistics.median(runs),
+                }
+            )
+        results.append(
+            {
+                "route": route,
+                "params": {k: str(v) for k, v in params.items()},
+                "raw_bytes": len(raw),
+                "served": served,
+                "local": local,
+            }
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time the lhserver report routes against a generated ledger."
+    )
+    parser.add_argument("--transactions", type=int, default=100000)
+    parser.add_argument("--years", type=int, default=10)
+    parser.add_argument("--accounts", type=int, default=20, help="per type & journal")
+    parser.add_argument("--journals", type=int, default=2)
+    parser.add_argument("--payees", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--report-cache", action="store_true", help="leave the report cache enabled"
+    )
+    parser.add_argument(
+        "--compression",
+        action="store_true",
+        help="compare compression cost & savings on the large reports",
+    )
+    parser.add_argument("--output", help="write the json results here")
+    args = parser.parse_args()
+
+    if not args.report_cache:
+        # time the queries rather than the report cache
+        os.environ["LHSERVER_REPORT_CACHE_BYTES"] = "0"
+
+    scale = {
+        "transactions": args.transactions,
+        "years": args.years,
+        "accounts": args.accounts,
+        "journals": args.journals,
+        "payees": args.payees,
+    }
+
+    dburl = test_url(TEST_DATABASE)
+    init_database(dburl)
+    t0 = time.perf_counter()
+    start, end = generate_ledger(dburl, scale)
+    generate_time = time.perf_counter() - t0
+
+    srvparams = {"dburl": dburl, "modules": ["lhserver"]}
+    with yenot.tests.server_running(**srvparams) as server:
+        session = yclient.YenotSession(server.url)
+        client = session.std_client()
+
+        # fill the derived tables for the generated ledger
+        client.put("api/gledger/daily-balances/rebuild")
+        client.put("api/transactions/account-summaries/rebuild")
+        client.put("api/gledger/unbalanced-trans/rebuild")
+
+        conn = psycopg2.connect(dburl)
+        routes = report_routes(conn, start, end)
+        conn.close()
+
+        results = time_routes(client, routes, args.repeat)
+        compression = None
+        if args.compression:
+            compression = time_compression(
+                session, server.url, compression_routes(start, end), args.repeat
+            )
+        session.close()
+
+    output = {
+        "scale": scale,
+        "generate_seconds": generate_time,
+        "routes": results,
+    }
+    if compression != None:
+        output["compression"] = compression
+    text = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,13 @@
 import os
 import sys
+import json
+import uuid
 import yenot.client as yclient
 import yenot.tests
 
 TEST_DATABASE = "yenot_e2e_test"
+COLUMNAR = "application/vnd.lhserver.columnar+json"
+NDJSON = "application/x-ndjson"
 
 
 def test_url(dbname):
@@ -13,6 +17,93 @@ def test_url(dbname):
     return f"postgresql:///{dbname}"
 
 
+def assert_rejected(call, *args, **kwargs):
+    try:
+        call(*args, **kwargs)
+    except Exception as e:
+        return str(e)
+    raise AssertionError("the server accepted a request it should reject")
+
+
+def put_transaction(client, trandate, payee, splits):
+    content = client.get("api/transaction/new")
+    trantable = content.named_table("trans")
+    sptable = content.named_table("splits")
+    trantable.rows[0].trandate = trandate
+    trantable.rows[0].payee = payee
+    for account_id, amount in splits:
+        with sptable.adding_row() as r2:
+            r2.account_id = account_id
+            r2.sum = amount
+    client.put(
+        "api/transaction/{}",
+        trantable.rows[0].tid,
+        files={
+            "trans": trantable.as_http_post_file(),
+            "splits": sptable.as_http_post_file(inclusions=["account_id", "sum"]),
+        },
+    )
+    return trantable.rows[0].tid
+
+
+def report_balance(content, acc_name):
+    rows = content.main_table().rows
+    return sum(float(row.balance) for row in rows if row.acc_name == acc_name)
+
+
+def payload_rows(doc):
+    """
+    Return the rows of the tab2 tables of a yenot payload as lists.
+    """
+    tables = doc.get("tables", {})
+    candidates = list(doc.values())
+    candidates += list(tables.values()) if isinstance(tables, dict) else []
+    rows = []
+    for table in candidates:
+        if isinstance(table, dict) and "columns" in table and "rows" in table:
+            rows += table["rows"]
+        elif isinstance(table, list) and len(table) == 2:
+            if all(isinstance(c, list) and len(c) == 2 for c in table[0]):
+                rows += table[1]
+    return rows
+
+
+def assert_varies_encoding(response):
+    vary = [v.strip() for v in response.headers.get("Vary", "").split(",")]
+    assert "Accept-Encoding" in vary
+
+
+def assert_streams_same(session, url, params):
+    response = session.get(url, params=params)
+    expected = payload_rows(response.json())
+    response = session.get(url, params=params, headers={"Accept": NDJSON})
+    assert response.headers["Content-Type"].startswith(NDJSON)
+    assert_varies_encoding(response)
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert len(lines) >= 1 and len(payload_rows(lines[0])) == 0
+    assert [row for line in lines for row in payload_rows(line)] == expected
+
+
+def columnar_tables(doc):
+    """
+    Decode the column arrays of a columnar response to lists of row dicts.
+    """
+    candidates = list(doc.values()) + list(doc.get("tables", {}).values())
+    tables = []
+    for table in candidates:
+        if not isinstance(table, dict) or "length" not in table:
+            continue
+        data = {}
+        for attr, values in table["data"].items():
+            if isinstance(values, dict):
+                lookup = values["dictionary"]
+                values = [None if i == None else lookup[i] for i in values["indices"]]
+            data[attr] = values
+        rows = [{attr: data[attr][i] for attr in data} for i in range(table["length"])]
+        tables.append(rows)
+    return tables
+
+
 def init_database(dburl):
     r = os.system(
         "{} ../yenot/scripts/init-database.py {} --full-recreate \
@@ -31,10 +122,45 @@ def test_basic_lists(srvparams):
         session = yclient.YenotSession(server.url)
         client = session.std_client()
 
-        client.get("api/accounts/list")
+        content = client.get("api/accounts/list")
+        account = content.main_table().rows[0].id
+        response = session.get(f"{server.url}/api/accounts/list")
+        etag = response.headers["ETag"]
+        response = session.get(
+            f"{server.url}/api/accounts/list",
+            headers={"If-None-Match": f'"other", {etag}'},
+        )
+        assert response.status_code == 304
+        content = client.get("api/account/{}/register", account, limit=2)
+        cursor = content.keys.get("prev-cursor")
+        if cursor != None:
+            client.get("api/account/{}/register", account, limit=2, before=cursor)
+        content = client.get(
+            "api/account/{}/register", account, limit=2, date="1900-01-01"
+        )
+        assert "prev-cursor" not in content.keys
+        assert_rejected(
+            client.get, "api/account/{}/register", account, after="2019-01-01/x/y"
+        )
         client.get("api/accounttypes/list")
         client.get("api/journals/list")
         client.get("api/transactions/list")
+        content = client.get("api/transactions/list", limit=1)
+        cursor = content.keys.get("next-cursor")
+        if cursor != None:
+            client.get("api/transactions/list", limit=1, after=cursor)
+        assert_rejected(
+            client.get, "api/transactions/list", limit=1, after="2019-01-01/x'--"
+        )
+        content = client.get("api/transactions/changes", since=0)
+        cursor = content.keys["cursor"]
+        content = client.get("api/transactions/changes", since=cursor)
+        assert len(content.main_table().rows) == 0
+        client.delete("api/transactions/changes", through=cursor)
+        content = client.get("api/transactions/changes", since=0)
+        assert content.keys["reset"]
+        content = client.get("api/transactions/changes", since=cursor)
+        assert not content.keys.get("reset", False)
 
         session.close()
 
@@ -219,14 +345,221 @@ def test_crud_transactions(srvparams):
         session.close()
 
 
+def test_period_close(srvparams):
+    with yenot.tests.server_running(**srvparams) as server:
+        session = yclient.YenotSession(server.url)
+        client = session.std_client()
+
+        acccontent = client.get("api/accounts/list")
+        accs = acccontent.main_table()
+        cash = next(row for row in accs.rows if row.account == "Cash")
+        food = next(row for row in accs.rows if row.account == "Food")
+
+        content = client.get("api/transactions/list")
+        existing = content.main_table().rows[0]
+
+        client.put("api/gledger/close-period", date="2018-12-31")
+        content = client.get("api/gledger/period-closes")
+        assert str(content.main_table().rows[0].close_date) == "2018-12-31"
+
+        # a new transaction in the closed period
+        content = client.get("api/transaction/new")
+        acctable = content.named_table("trans")
+        sptable = content.named_table("splits")
+        acctable.rows[0].trandate = "2018-06-01"
+        acctable.rows[0].payee = "Closed Period"
+        with sptable.adding_row() as r2:
+            r2.account_id = cash.id
+            r2.sum = -1
+        with sptable.adding_row() as r2:
+            r2.account_id = food.id
+            r2.sum = 1
+        assert_rejected(
+            client.put,
+            "api/transaction/{}",
+            acctable.rows[0].tid,
+            files={
+                "trans": acctable.as_http_post_file(),
+                "splits": sptable.as_http_post_file(inclusions=["account_id", "sum"]),
+            },
+        )
+        assert_rejected(client.delete, "api/transaction/{}", existing.tid)
+        assert_rejected(client.put, "api/gledger/close-period", date="2018-11-30")
+
+        client.delete("api/gledger/close-period", date="2018-12-31")
+        content = client.get("api/gledger/period-closes")
+        assert len(content.main_table().rows) == 0
+
+        session.close()
+
+
+def test_report_cache(srvparams):
+    with yenot.tests.server_running(**srvparams) as server:
+        session = yclient.YenotSession(server.url)
+        client = session.std_client()
+
+        acccontent = client.get("api/accounts/list")
+        accs = acccontent.main_table()
+        cash = next(row for row in accs.rows if row.account == "Cash")
+        food = next(row for row in accs.rows if row.account == "Food")
+
+        def balances():
+            bs = client.get("api/gledger/balance-sheet", date="2018-12-31")
+            pl = client.get(
+                "api/gledger/profit-and-loss", date1="2018-01-01", date2="2018-12-31"
+            )
+            return report_balance(bs, "Cash"), report_balance(pl, "Food")
+
+        # the second request is served from the cache
+        cash1, food1 = balances()
+        assert balances() == (cash1, food1)
+
+        tid = put_transaction(
+            client, "2018-12-15", "Grocer", [(cash.id, -10), (food.id, 10)]
+        )
+        cash2, food2 = balances()
+        assert abs(cash2 - (cash1 - 10)) < 0.005
+        assert abs(food2 - (food1 + 10)) < 0.005
+
+        client.delete("api/transaction/{}", tid)
+        cash3, food3 = balances()
+        assert abs(cash3 - cash1) < 0.005
+        assert abs(food3 - food1) < 0.005
+
+        session.close()
+
+
+def import_csv(client, rows):
+    lines = ["tid,trandate,tranref,payee,memo,account_id,sum"]
+    lines += [",".join(str(value) for value in row) for row in rows]
+    text = "\n".join(lines) + "\n"
+    return client.put("api/transactions/import", files={"csv": ("import.csv", text)})
+
+
+def test_import(srvparams):
+    with yenot.tests.server_running(**srvparams) as server:
+        session = yclient.YenotSession(server.url)
+        client = session.std_client()
+
+        acccontent = client.get("api/accounts/list")
+        accs = acccontent.main_table()
+        cash = next(row for row in accs.rows if row.account == "Cash").id
+        food = next(row for row in accs.rows if row.account == "Food").id
+
+        rows = []
+        for index, trandate in enumerate(["2019-02-01", "2019-02-08", "2019-02-15"]):
+            tid = uuid.uuid1()
+            rows.append((tid, trandate, "", f"Grocer {index}", "", cash, -20))
+            rows.append((tid, trandate, "", f"Grocer {index}", "", food, 20))
+        content = import_csv(client, rows)
+        assert content.keys["imported"] == 3
+
+        content = client.get("api/gledger/daily-balances/verify")
+        assert len(content.main_table().rows) == 0
+
+        # the same tid with two payees
+        tid = uuid.uuid1()
+        assert_rejected(
+            import_csv,
+            client,
+            [
+                (tid, "2019-03-01", "", "Grocer", "", cash, -20),
+                (tid, "2019-03-01", "", "Baker", "", food, 20),
+            ],
+        )
+        # the transactions are already imported
+        assert_rejected(import_csv, client, rows)
+
+        client.put("api/gledger/close-period", date="2019-01-31")
+        tid = uuid.uuid1()
+        assert_rejected(
+            import_csv,
+            client,
+            [
+                (tid, "2019-01-15", "", "Grocer", "", cash, -20),
+                (tid, "2019-01-15", "", "Grocer", "", food, 20),
+            ],
+        )
+        client.delete("api/gledger/close-period", date="2019-01-31")
+
+        session.close()
+
+
+def put_reconcile_delta(client, account, version, trans, row):
+    trans.rows[:] = [row]
+    return client.put(
+        "api/transactions/reconcile/delta",
+        account=account,
+        version=version,
+        files={
+            "trans": trans.as_http_post_file(
+                inclusions=["sid", "pending", "reconciled"]
+            )
+        },
+    )
+
+
+def test_reconcile(srvparams):
+    with yenot.tests.server_running(**srvparams) as server:
+        session = yclient.YenotSession(server.url)
+        client = session.std_client()
+
+        acccontent = client.get("api/accounts/list")
+        accs = acccontent.main_table()
+        cash = next(row for row in accs.rows if row.account == "Cash").id
+        food = next(row for row in accs.rows if row.account == "Food").id
+
+        content = client.get("api/transactions/reconcile", account=cash)
+        version = content.keys["reconcile-version"]
+        trans = content.named_table("trans")
+        first, second = trans.rows[0], trans.rows[1]
+        first.reconciled = True
+        content = put_reconcile_delta(client, cash, version, trans, first)
+        newversion = content.keys["reconcile-version"]
+        assert newversion != version
+
+        # a page older than the save is refused
+        second.reconciled = True
+        assert_rejected(put_reconcile_delta, client, cash, version, trans, second)
+
+        # a concurrent edit of the account's splits makes the page stale
+        put_transaction(client, "2019-04-01", "Grocer", [(cash, -3), (food, 3)])
+        assert_rejected(put_reconcile_delta, client, cash, newversion, trans, second)
+
+        content = client.get("api/transactions/reconcile", account=cash)
+        version = content.keys["reconcile-version"]
+        trans = content.named_table("trans")
+        sids = [row.sid for row in trans.rows]
+        assert first.sid not in sids
+        row = next(row for row in trans.rows if row.sid == second.sid)
+        row.reconciled = True
+        put_reconcile_delta(client, cash, version, trans, row)
+
+        content = client.get("api/transactions/reconcile", account=cash)
+        assert second.sid not in [row.sid for row in content.named_table("trans").rows]
+
+        session.close()
+
+
 def test_financial_reports(srvparams):
     with yenot.tests.server_running(**srvparams) as server:
         session = yclient.YenotSession(server.url)
         client = session.std_client()
 
         client.get("api/gledger/unbalanced-trans")
+        content = client.get("api/gledger/daily-balances/verify")
+        assert len(content.main_table().rows) == 0
+        client.get("api/gledger/period-closes")
         client.get("api/gledger/balance-sheet", date1="2019-12-31")
         client.get("api/gledger/multi-balance-sheet", year=2019, month_end=6, count=4)
+        content = client.get("api/gledger/balance-sheet", date="2019-12-31")
+        version = content.keys["ledger-version"]
+        content = client.get(
+            "api/gledger/balance-sheet",
+            date="2019-12-31",
+            **{"if-changed-since": version},
+        )
+        assert content.keys["unchanged"]
         client.get(
             "api/gledger/profit-and-loss", date1="2018-01-01", date2="2018-12-31"
         )
@@ -237,6 +570,33 @@ def test_financial_reports(srvparams):
             intervals=3,
             length=4,
         )
+        params = {"date1": "2018-01-01", "date2": "2019-12-31"}
+        content = client.get("api/transactions/tran-detail", **params)
+        expected = [(row.payee, row.acc_name) for row in content.main_table().rows]
+        response = session.get(
+            f"{server.url}/api/transactions/tran-detail",
+            params=params,
+            headers={"Accept": COLUMNAR},
+        )
+        assert response.headers["Content-Type"].startswith(COLUMNAR)
+        (rows,) = columnar_tables(response.json())
+        assert [(row["payee"], row["acc_name"]) for row in rows] == expected
+        assert_streams_same(
+            session, f"{server.url}/api/transactions/tran-detail", params
+        )
+        assert_streams_same(session, f"{server.url}/api/gledger/detailed-pl", params)
+
+        # caches must key on the encoding even where the body is too small
+        # to compress
+        response = session.get(
+            f"{server.url}/api/accounts/completions", params={"prefix": "zz"}
+        )
+        assert len(response.content) < 1024
+        assert_varies_encoding(response)
+        content = client.get("api/hacc/perf-stats")
+        routes = {row.route: row for row in content.main_table().rows}
+        assert routes["api_gledger_balance_sheet"].queries > 0
+        assert all(row.serialize_p50 != None for row in routes.values())
 
 
 if __name__ == "__main__":
@@ -248,5 +608,9 @@ if __name__ == "__main__":
     test_crud_accounts(srvparams)
     test_prep_data(srvparams)
     test_crud_transactions(srvparams)
+    test_period_close(srvparams)
+    test_report_cache(srvparams)
+    test_import(srvparams)
+    test_reconcile(srvparams)
     test_basic_lists(srvparams)
     test_financial_reports(srvparams)